@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+
+import io
+import sys
+import json
+import time
+import socket
+import argparse
+import itertools
+import resource
+import platform
+import tracemalloc
+import contextlib
+import numpy as np
+
+from lappdIfc import *
+from lappdSim import lappdSimBoard
+
+#####################################################
+# Benchmarks of readout, calibration and pedestals
+# against the simulated board
+#
+#   python3 lappdBench.py -o bench.json --latency 0 1e-4 --batch 60 180
+#   python3 lappdBench.py --compare old.json bench.json
+#
+# every case runs for each point of the parameter grid
+# (cartesian product of the swept parameters), results
+# are kept in a json file to compare runs over time
+#####################################################
+
+BENCH_DEFAULTS = {
+    'latency' : 0,     # s, simulated round trip
+    'batch'   : 180,   # lappdInterface.ReadBatchSize
+    'ncal'    : 100,   # lappdInterface.NCalSamples
+    'nchans'  : 1,     # channels read per event
+    'bulk'    : True   # lappdInterface.BulkRead
+}
+
+# case(ifc, prm, n) -> number of events processed
+def BenchReadMem(ifc, prm, n) :
+    for i in range(n) :
+        ifc.AdcBufStart()
+        ifc.SoftTrigger()
+        ifc.ReadMem(0, 4200, ifc.WfChan)
+    return n
+
+def BenchReadWf(ifc, prm, n) :
+    for i in range(n) :
+        ifc.AdcBufStart()
+        ifc.SoftTrigger()
+        ifc.ReadWf()
+    return n
+
+def BenchReadWfs(ifc, prm, n) :
+    chans = list(range(prm['nchans']))
+    for i in range(n) :
+        ifc.AdcBufStart()
+        ifc.SoftTrigger()
+        ifc.WaitBufReady()
+        ifc.ReadWfs(chans)
+    return n
+
+def BenchMeasurePeds(ifc, prm, n) :
+    ifc.MeasurePeds(n, list(range(prm['nchans'])))
+    return n
+
+def BenchCalibrateIDelaysDataAll(ifc, prm, n) :
+    ifc.CalibrateIDelaysDataAll()
+    return 1
+
+def BenchInitialize(ifc, prm, n) :
+    ifc.Initialize()
+    return 1
+
+# name : (function, needs an initialized board, default number of events)
+BENCH_CASES = {
+    'ReadMem'                 : (BenchReadMem                , True , 20),
+    'ReadWf'                  : (BenchReadWf                 , True , 20),
+    'ReadWfs'                 : (BenchReadWfs                , True , 20),
+    'MeasurePeds'             : (BenchMeasurePeds            , True , 5),
+    'CalibrateIDelaysDataAll' : (BenchCalibrateIDelaysDataAll, True , 1),
+    'Initialize'              : (BenchInitialize             , False, 1)
+}
+
+def MakeInterface(prm, seed = 1) :
+    brd = lappdSimBoard(latency = prm['latency'], seed = seed)
+    ifc = lappdInterface(brd = brd)
+    ifc.ReadBatchSize = prm['batch']
+    ifc.NCalSamples   = prm['ncal']
+    ifc.BulkRead      = prm['bulk']
+    return ifc, brd
+
+# one case at one parameter point, best of repeat runs
+# mem : one more run under tracemalloc for the peak memory,
+#       tracing slows python down so it is not timed
+def RunCase(name, prm, n = 0, repeat = 3, mem = True, quiet = True) :
+    func, init, ndef = BENCH_CASES[name]
+    if n <= 0 : n = ndef
+    res = None
+    for irep in range(repeat + int(mem)) :
+        trace = mem and irep == repeat
+        ifc, brd = MakeInterface(prm)
+        log = io.StringIO() if quiet else sys.stderr
+        with contextlib.redirect_stderr(log) :
+            if init : ifc.Initialize(doCal = False)
+            ntr0, nxfer0 = brd.nTransactions, brd.nTransfers
+            if trace : tracemalloc.start()
+            t0 = time.perf_counter()
+            nev = func(ifc, prm, n)
+            wall = time.perf_counter() - t0
+            if trace :
+                res['mem_peak'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                continue
+        ntr = brd.nTransactions - ntr0
+        r = {
+            'case'         : name,
+            'params'       : dict(prm),
+            'events'       : nev,
+            'wall'         : wall,
+            'transactions' : ntr,
+            'transfers'    : brd.nTransfers - nxfer0,
+            'trans_rate'   : ntr / wall,
+            'event_rate'   : nev / wall,
+            'mem_peak'     : 0 # bytes allocated by python during the case
+        }
+        if res is None or r['wall'] < res['wall'] : res = r
+    return res
+
+# params : {name : list of values}, missing names take BENCH_DEFAULTS
+def RunSweep(cases, params, n = 0, repeat = 3, f = sys.stderr) :
+    names = list(BENCH_DEFAULTS)
+    grid = [params.get(k, [BENCH_DEFAULTS[k]]) for k in names]
+    results = []
+    for name in cases :
+        for vals in itertools.product(*grid) :
+            prm = dict(zip(names, vals))
+            r = RunCase(name, prm, n, repeat)
+            results.append(r)
+            if f is not None : PrintResult(r, f)
+    return {
+        'time'    : time.time(),
+        'host'    : socket.gethostname(),
+        'python'  : platform.python_version(),
+        'numpy'   : np.__version__,
+        'maxrss'  : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, # kB
+        'results' : results
+    }
+
+def ParamStr(prm) :
+    return ' '.join('%s=%s' % (k, v) for k, v in prm.items())
+
+def PrintResult(r, f = sys.stderr) :
+    print('%-24s %-50s %9.4f s %10.0f tr/s %9.1f ev/s %8.1f MB' % (r['case'], ParamStr(r['params']),
+          r['wall'], r['trans_rate'], r['event_rate'], r['mem_peak'] / 1e6), file=f)
+
+def SaveResults(res, fname) :
+    with open(fname, 'w') as f : json.dump(res, f, indent = 1)
+
+def LoadResults(fname) :
+    with open(fname) as f : return json.load(f)
+
+# wall time ratio new/old for every case and parameter point in both
+def Compare(old, new, f = sys.stderr) :
+    def key(r) : return (r['case'], json.dumps(r['params'], sort_keys = True))
+    ref = {key(r) : r for r in old['results']}
+    ratios = {}
+    for r in new['results'] :
+        o = ref.get(key(r))
+        if o is None : continue
+        ratios[key(r)] = r['wall'] / o['wall']
+        if f is not None :
+            print('%-24s %-50s %9.4f -> %9.4f s  x%.2f' % (r['case'], ParamStr(r['params']),
+                  o['wall'], r['wall'], ratios[key(r)]), file=f)
+    return ratios
+
+if __name__ == '__main__' :
+    ap = argparse.ArgumentParser(description = 'lappdIfc benchmarks on the simulated board')
+    ap.add_argument('-c', '--cases', nargs = '+', default = list(BENCH_CASES), choices = list(BENCH_CASES))
+    ap.add_argument('-n', '--nev', type = int, default = 0, help = 'events per case, default per case')
+    ap.add_argument('-r', '--repeat', type = int, default = 3)
+    ap.add_argument('-o', '--output', default = '', help = 'json file for the results')
+    ap.add_argument('--latency', nargs = '+', type = float)
+    ap.add_argument('--batch', nargs = '+', type = int)
+    ap.add_argument('--ncal', nargs = '+', type = int)
+    ap.add_argument('--nchans', nargs = '+', type = int)
+    ap.add_argument('--bulk', nargs = '+', type = int)
+    ap.add_argument('--compare', nargs = 2, metavar = ('OLD', 'NEW'))
+    args = ap.parse_args()
+
+    if args.compare :
+        Compare(LoadResults(args.compare[0]), LoadResults(args.compare[1]), sys.stdout)
+        sys.exit(0)
+
+    params = {k : getattr(args, k) for k in BENCH_DEFAULTS if getattr(args, k) is not None}
+    if 'bulk' in params : params['bulk'] = [bool(b) for b in params['bulk']]
+    res = RunSweep(args.cases, params, args.nev, args.repeat, sys.stdout)
+    if args.output : SaveResults(res, args.output)
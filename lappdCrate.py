@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+import sys
+import time
+import threading
+import traceback
+import concurrent.futures
+
+from lappdIfc import lappdInterface
+
+#####################################################
+# Several boards controlled from one process
+# board operations run concurrently on a thread pool,
+# the boards spend most of the time waiting for the
+# network so threads are enough
+#####################################################
+class lappdCrate :
+    # brds : optional board backends, one per ip (see lappdInterface)
+    def __init__(self, ips, udpsport = 8989, nworkers = 0, shadow = False, brds = None) :
+        if brds is None : brds = [None]*len(ips)
+        self.boards   = [lappdInterface(ip, udpsport, shadow, brd) for ip, brd in zip(ips, brds)]
+        self.nworkers = nworkers if nworkers > 0 else len(ips)
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.nworkers)
+        self.status   = [{'ip' : b.ip, 'ok' : None, 'error' : ''} for b in self.boards]
+
+    def __len__(self) :
+        return len(self.boards)
+
+    def __getitem__(self, i) :
+        return self.boards[i]
+
+    # run func(board, *args) on all boards concurrently
+    # returns list of results, None for boards which failed (see Status)
+    def Map(self, func, *args) :
+        futs = [self.executor.submit(func, b, *args) for b in self.boards]
+        res = []
+        for ib, fut in enumerate(futs) :
+            try :
+                res.append(fut.result())
+                self.status[ib]['ok'] = True
+                self.status[ib]['error'] = ''
+            except Exception as e :
+                print('board %s : %s' % (self.boards[ib].ip, e), file=sys.stderr)
+                traceback.print_exc(file=sys.stderr)
+                res.append(None)
+                self.status[ib]['ok'] = False
+                self.status[ib]['error'] = str(e)
+        return res
+
+    def Initialize(self, doCal = True, calFile = "") :
+        t0 = time.time()
+        self.Map(lambda b : b.Initialize(doCal, calFile))
+        print('crate initialized in %.1f s' % (time.time() - t0), file=sys.stderr)
+        return self.Status()
+
+    def CalibrateIDelays(self) :
+        def cal(b) :
+            if b.fwver >= 100 : b.CalibrateIDelaysFrameAll()
+            b.CalibrateIDelaysDataAll()
+        self.Map(cal)
+        return self.Status()
+
+    def MeasurePeds(self, nev = 5) :
+        self.Map(lambda b : b.MeasurePeds(nev))
+        return self.Status()
+
+    # per board status : ip, fw version, PLL lock, calibration and last operation result
+    def Status(self) :
+        for st, b in zip(self.status, self.boards) :
+            st['fwver']  = b.fwver
+            st['pll']    = b.pll
+            st['pll_ok'] = b.pll == 0xff
+            st['cal_ok'] = all(d is not None and (d >= 0).all() for d in b.DataDelays)
+        return self.status
+
+    def PrintStatus(self, f = sys.stderr) :
+        print('%-16s %5s %6s %6s %4s  %s' % ('board', 'fw', 'pll', 'cal', 'ok', 'error'), file=f)
+        for st in self.Status() :
+            print('%-16s %5d %6s %6s %4s  %s' % (st['ip'], st['fwver'], bin(st['pll']),
+                  st['cal_ok'], st['ok'], st['error']), file=f)
+
+    # software trigger on all boards at once : the writes are released
+    # together by a barrier so the skew is one network round trip
+    def Trigger(self) :
+        if self.nworkers < len(self.boards) :
+            raise Exception('crate trigger needs one worker per board')
+        barrier = threading.Barrier(len(self.boards))
+        def trg(b) :
+            barrier.wait()
+            b.SoftTrigger()
+        self.Map(trg)
+
+    def Close(self) :
+        self.executor.shutdown()
@@ -2,10 +2,26 @@
 
 import sys
 import os
-import eevee 
 import time
+import json
+import zlib
+import socket
+import threading
+import collections
+import functools
+import concurrent.futures
 import numpy as np
 
+from lappdPeds import lappdPedestals
+from lappdTime import lappdTimeCalib
+from lappdRegMap import *
+
+# eevee is needed for real boards only, see lappdSim for a simulated board
+try :
+    import eevee
+except ImportError :
+    eevee = None
+
 # temporarily here
 SW_VERSION      = 0x0000
 FW_VERSION      = 0x0004
@@ -101,20 +117,216 @@ ADDR_ADCBUF_OFFSET = (3 << 18) # ADC buffer reg interface
 ADDR_DRSCFG_OFFSET = (4 << 18) # DRS4 registers
 ADDR_PEDMEM_OFFSET = (8 << 18) # Pedestals memory
 
+# pedestal memory : one 32-bit word per DRS cell, channels are 1024 words apart,
+# pedestals are stored in the ADC sample format (12-bit two's complement)
+PEDMEM_NCELLS = 1024
+PEDMEM_MASK   = 0xfff
+
+def PedMemAddr(chan, cell) :
+    return ADDR_PEDMEM_OFFSET + ((chan*PEDMEM_NCELLS + cell) << 2)
+
+# registers changed by the hardware, never served from the shadow copy
+VOLATILE_REGS = [STATUS, DRSPLLLCK, ADCBUFCURADDR, ADCDEBUG1, ADCBUFDEBUG, ADCWORDSWRITTEN,
+    BITSLIPCNT, ADCFRAMEDEBUG, EBDEBUG, EXTTRGCNT] + \
+    [ADCDELAYDEBUG + 4*i for i in range(64)] + [DRSSTOPSAMPLE_0 + 4*i for i in range(8)]
+# registers whose bits are pulses, read back value is meaningless
+STROBE_REGS = [CMD]
+
+# registers saved in run file headers
+SNAPSHOT_REGS = [
+    ('FW_VERSION'     , FW_VERSION),
+    ('DEVICEDNA_L'    , DEVICEDNA_L),
+    ('DEVICEDNA_H'    , DEVICEDNA_H),
+    ('MODE'           , MODE),
+    ('ADCBUFNUMWORDS' , ADCBUFNUMWORDS),
+    ('DRSREFCLKRATIO' , DRSREFCLKRATIO),
+    ('DRSVALIDDELAY'  , DRSVALIDDELAY),
+    ('DRSWAITADDR'    , DRSWAITADDR),
+    ('NSAMPLEPACKET'  , NSAMPLEPACKET),
+    ('ADCCHANMASK_0'  , ADCCHANMASK_0),
+    ('ADCCHANMASK_1'  , ADCCHANMASK_0 + 4),
+    ('NUDPPORTS'      , NUDPPORTS),
+    ('ADCFRAMEDELAY_0', ADCFRAMEDELAY_0),
+    ('ADCFRAMEDELAY_1', ADCFRAMEDELAY_0 + 4),
+    ('BITSLIP_0'      , BITSLIP),
+    ('BITSLIP_1'      , BITSLIP + 4),
+]
+
+#####################################################
+# Register map, see lappdRegMap
+#####################################################
+MODE_FIELDS = {
+    'ADCBUF_WREN'  : (C_MODE_ADCBUF_WREN_BIT , 1),
+    'DRS_TRANS'    : (C_MODE_DRS_TRANS_BIT   , 1),
+    'DRS_DENABLE'  : (C_MODE_DRS_DENABLE_BIT , 1),
+    'TCA_ENA'      : (C_MODE_TCA_ENA_BIT     , 1),
+    'EB_FRDISABLE' : (C_MODE_EB_FRDISABLE_BIT, 1),
+    'EXTTRG_EN'    : (C_MODE_EXTTRG_EN_BIT   , 1),
+    'DRS_REVRS'    : (C_MODE_DRS_REVRS_BIT   , 1),
+    'CLKIN_TRG'    : (C_MODE_CLKIN_TRG_BIT   , 1),
+    'PEDSUB_EN'    : (C_MODE_PEDSUB_EN_BIT   , 1),
+    'ZERSUP_EN'    : (C_MODE_ZERSUP_EN_BIT   , 1)
+}
+CMD_FIELDS = {
+    'RESET'    : (C_CMD_RESET_BIT   , 1),
+    'ADCTXTRG' : (C_CMD_ADCTXTRG_BIT, 1),
+    'ADCRESET' : (C_CMD_ADCRESET_BIT, 1),
+    'READREQ'  : (C_CMD_READREQ_BIT , 1),
+    'RUNRESET' : (C_CMD_RUNRESET_BIT, 1)
+}
+
+LAPPD_REGMAP = lappdRegMap([
+    lappdReg('FW_VERSION'     , FW_VERSION     , REG_RO),
+    lappdReg('DEVICEDNA_L'    , DEVICEDNA_L    , REG_RO),
+    lappdReg('DEVICEDNA_H'    , DEVICEDNA_H    , REG_RO),
+    lappdReg('SCRATCH'        , SCRATCH),
+    lappdReg('DESTMAC_LOW'    , DESTMAC_LOW),
+    lappdReg('DESTMAC_HIGH'   , DESTMAC_HIGH),
+    lappdReg('DESTIP'         , DESTIP),
+    lappdReg('NBIC_PORTS'     , NBIC_PORTS     , fields = {'SPORT' : (0, 16), 'DPORT' : (16, 16)}),
+    lappdReg('CMD'            , CMD            , REG_STROBE, CMD_FIELDS),
+    lappdReg('ADCBUFNUMWORDS' , ADCBUFNUMWORDS , default = 1024, doc = '<= 1024 : ROI mode, FULL mode otherwise'),
+    lappdReg('ADCDEBUG1'      , ADCDEBUG1      , REG_RO),
+    lappdReg('ADCCLKDELAY'    , ADCCLKDELAY),
+    lappdReg('ADCFRAMEDELAY_0', ADCFRAMEDELAY_0    , minfw = 100),
+    lappdReg('ADCFRAMEDELAY_1', ADCFRAMEDELAY_0 + 4, minfw = 100),
+    lappdReg('BITSLIP_0'      , BITSLIP        , REG_STROBE),
+    lappdReg('BITSLIP_1'      , BITSLIP + 4    , REG_STROBE),
+    lappdReg('ADCDEBUGCHAN'   , ADCDEBUGCHAN),
+    lappdReg('BITSLIPCNT'     , BITSLIPCNT     , REG_RO),
+    lappdReg('MODE'           , MODE           , fields = MODE_FIELDS),
+    lappdReg('DRSPLLLCK'      , DRSPLLLCK      , REG_RO),
+    lappdReg('ADCBUFCURADDR'  , ADCBUFCURADDR  , REG_RO),
+    lappdReg('STATUS'         , STATUS         , REG_RO),
+    lappdReg('DRSREFCLKRATIO' , DRSREFCLKRATIO),
+    lappdReg('DRSADCPHASE'    , DRSADCPHASE),
+    lappdReg('NSAMPLEPACKET'  , NSAMPLEPACKET),
+    lappdReg('DRSVALIDPHASE'  , DRSVALIDPHASE),
+    lappdReg('DRSVALIDDELAY'  , DRSVALIDDELAY),
+    lappdReg('DRSWAITADDR'    , DRSWAITADDR    , minfw = 100),
+    lappdReg('NUDPPORTS'      , NUDPPORTS),
+    lappdReg('EXTTRGCNT'      , EXTTRGCNT      , REG_RO),
+    lappdReg('DRSCFG'         , ADDR_DRSCFG_OFFSET    , REG_WO, doc = 'DRS4 configuration register'),
+    lappdReg('DRSWREG'        , ADDR_DRSCFG_OFFSET + 4, REG_WO, doc = 'DRS4 write configuration register')
+])
+LAPPD_REGMAP.Array('ADCDATADELAY' , ADCDATADELAY_0 , 64)
+LAPPD_REGMAP.Array('ADCDELAYDEBUG', ADCDELAYDEBUG  , 64, access = REG_RO)
+LAPPD_REGMAP.Array('DRSSTOPSAMPLE', DRSSTOPSAMPLE_0, 8 , access = REG_RO)
+LAPPD_REGMAP.Array('ADCCHANMASK'  , ADCCHANMASK_0  , 2)
+LAPPD_REGMAP.Array('ZEROTHRESH'   , ZEROTHRESH_0   , 64)
+
+# run type profiles, see lappdInterface.ApplyProfile
+LAPPD_PROFILES = {
+    'pedestal' : {'MODE' : {'EXTTRG_EN' : 0, 'TCA_ENA' : 0, 'PEDSUB_EN' : 0, 'ZERSUP_EN' : 0}},
+    'timecal'  : {'MODE' : {'EXTTRG_EN' : 0, 'TCA_ENA' : 1, 'PEDSUB_EN' : 0, 'ZERSUP_EN' : 0}},
+    'physics'  : {'MODE' : {'EXTTRG_EN' : 1, 'TCA_ENA' : 0, 'PEDSUB_EN' : 1, 'ZERSUP_EN' : 1}}
+}
+
+#####################################################
+# ADC buffer word decoding
+#####################################################
+ADC_UNDERFLOW = -9999 # sample flag 1
+ADC_OVERFLOW  =  9999 # any other non-zero sample flag
+
+# split 16-bit buffer words into 12-bit two's complement sample and 4-bit flag
+def DecodeAdcWords(raw) :
+    raw = np.asarray(raw, dtype = np.uint32)
+    v = ((raw >> 4) & 0xfff).astype(np.int16)
+    v = v - ((v & 0x800) << 1)
+    f = raw & 0xf
+    v[f == 1] = ADC_UNDERFLOW
+    v[f >  1] = ADC_OVERFLOW
+    return v
+
+# longest window of consecutive good delays in every row of good
+# returns first and last delay of the windows, -1 if no good delay
+def EyeWindows(good) :
+    good = np.asarray(good, dtype = bool)
+    nrows = good.shape[0]
+    pad = np.zeros((nrows, 1), dtype = np.int8)
+    d = np.diff(np.hstack((pad, good.astype(np.int8), pad)), axis = 1)
+    rows, starts = np.nonzero(d == 1)
+    ends = np.nonzero(d == -1)[1] - 1
+    first = np.full(nrows, -1)
+    last  = np.full(nrows, -1)
+    lens  = np.zeros(nrows, dtype = int)
+    for r, a, b in zip(rows, starts, ends) :
+        if b - a + 1 > lens[r] :
+            first[r], last[r], lens[r] = a, b, b - a + 1
+    return first, last
+
+# DRS samples are every 4th word of the decoded buffer starting from offset
+# (last axis for several channels)
+def ExtractSamples(dec, offset, nsamples = 1024) :
+    return dec[..., offset : offset + 4*nsamples : 4]
+
+# attribute the time of a method to an operation of the attached profiler
+# (lappdProf), no overhead without profiler
+def Profiled(func) :
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs) :
+        if self.prof is None : return func(self, *args, **kwargs)
+        with self.prof.Op(func.__name__) :
+            return func(self, *args, **kwargs)
+    return wrapper
+
+# serializes updates of calibration cache files (see SaveCalib)
+_calib_lock = threading.Lock()
+
 
 class lappdInterface :
-    def __init__(self, ip = '10.0.6.193', udpsport = 8989):
+    # brd : board backend with the eevee.board interface (peeknow, pokenow, peek,
+    #       poke, transfer), e.g. lappdSim.lappdSimBoard, eevee.board by default
+    def __init__(self, ip = '10.0.6.193', udpsport = 8989, shadow = False, brd = None):
         self.xx = 0
+        self.ip = ip
+        self.fwver = -1
+        self.pll   = 0
         # self.brd = eevee.board('10.0.6.212', udpsport = 7778)
-        self.brd = eevee.board(ip, udpsport = udpsport) 
+        if brd is not None :
+            self.brd = brd
+        elif eevee is not None :
+            self.brd = eevee.board(ip, udpsport = udpsport) 
+        else :
+            raise Exception('eevee module is not available, pass brd to use another board backend')
         self.peds = [0]*1024
         self.rmss = [0]*1024
+        self.pedtab = None # lappdPedestals of the last measurement
+        self.timecal = None # lappdTimeCalib of the last timing calibration
+        self.WfChan = 15   # debug channel read by ReadWf
+        self.HwPedSub = False # pedestals are subtracted by the firmware
+        self.zsthr    = {}    # zero suppression thresholds per channel
         self.AdcSampleOffset = 12
         self.TestPattern = [0xabc, 0x543]
         self.NCalSamples = 100
         self.drsrefclk = 51
         self.mask_adc1 = 1 << 15;
         self.mask_adc2 = 1 << 23;
+        # results of the last data IDELAY calibration per ADC
+        self.IDelayWindows = [None, None] # (first, last) good delay per channel
+        self.DataDelays    = [None, None] # chosen delay per channel, -1 if none
+        self.FrameDelays   = [None, None]
+        self.Bitslips      = [[], []] # bitslip masks written since the last reset, in order
+        self.CalMaxAge     = 7*24*3600 # s, older cached calibrations are redone
+        self.CalNProbes    = 8 # samples per channel for verification of cached calibration
+        # timeouts (s) of register polling, see WaitReg
+        self.FrameTimeout  = 0.01 # frame lock after a frame delay change
+        self.FrameSettle   = 0.002 # STATUS shows the lock of the previous frame delay until then
+        self.PllTimeout    = 0.1  # DRS4 PLL lock
+        self.BufTimeout    = 0.1  # ADC buffer filled after a trigger
+        # bulk register access : number of transactions queued before each
+        # eevee transfer (~1500 byte MTU / 8 bytes per transaction)
+        self.BulkRead = True
+        self.ReadBatchSize = 180
+        # shadow registers : local copy of the main register space so that
+        # RegSetBit costs one write instead of a read and a write
+        self.UseShadow    = shadow
+        self.shadow       = {}
+        self.VolatileRegs = set(VOLATILE_REGS)
+        self.StrobeRegs   = set(STROBE_REGS)
+        self.regmap       = LAPPD_REGMAP
+        self.pipe         = None # lappdRegPipeline when asynchronous access is used
+        self.prof         = None # lappdProf.lappdProfiler when register traffic is profiled
 
         # dict for DAC voltages 'name' : [OUTN, VOLTS] 
         self.DACOUTS = {
@@ -130,26 +342,213 @@ class lappdInterface :
         
     def RegRead(self, addr) :
         if type(addr) != int : addr = int(addr,0)
-        val = self.brd.peeknow(addr)
+        shadowed = self.Shadowed(addr) and addr not in self.StrobeRegs
+        if shadowed and addr in self.shadow : return self.shadow[addr]
+        if self.pipe is not None : val = self.pipe.Call([(addr,)])[0]
+        else :
+            t0 = time.perf_counter()
+            val = self.brd.peeknow(addr)
+            if self.prof is not None : self.prof.Record((addr,), t0)
+        if shadowed : self.shadow[addr] = val
         return val
 
     def RegWrite(self, addr, value) :
         if type(addr)  != int : addr  = int(addr,0)
         if type(value) != int : value = int(value,0)
-        self.brd.pokenow(addr, value)
+        if self.pipe is not None : self.pipe.Call([(addr, value)])
+        else :
+            t0 = time.perf_counter()
+            self.brd.pokenow(addr, value)
+            if self.prof is not None : self.prof.Record((addr,), t0)
+        self.ShadowUpdate(addr, value)
         return 0
 
+    # several transactions queued into as few transfers as possible
+    # ops : list of (addr,) for reads and (addr, value) for writes
+    # returns read values in the order of the read requests
+    def RegBatch(self, ops) :
+        for op in ops :
+            if len(op) == 2 : self.ShadowUpdate(op[0], op[1])
+        if self.pipe is not None : return self.pipe.Call(ops)
+        return self.BrdBatch(ops)
+
+    # raw board access : transfers of at most ReadBatchSize transactions
+    def BrdBatch(self, ops) :
+        rd = []
+        if not self.BulkRead :
+            for op in ops :
+                t0 = time.perf_counter()
+                if len(op) == 1 : rd.append(self.brd.peeknow(op[0]))
+                else : self.brd.pokenow(op[0], op[1])
+                if self.prof is not None : self.prof.Record((op[0],), t0)
+            return rd
+        for i0 in range(0, len(ops), self.ReadBatchSize) :
+            t0 = time.perf_counter()
+            irds = []
+            for i, op in enumerate(ops[i0 : i0 + self.ReadBatchSize]) :
+                if len(op) == 1 :
+                    self.brd.peek(op[0])
+                    irds.append(i)
+                else :
+                    self.brd.poke(op[0], op[1])
+            resp = self.brd.transfer()
+            if self.prof is not None : self.prof.Record([op[0] for op in ops[i0 : i0 + self.ReadBatchSize]], t0)
+            rd += [resp[i] for i in irds]
+        return rd
+
+    # read the same address (ADC buffer FIFO) num times
+    def RegReadBlock(self, addr, num) :
+        if type(addr) != int : addr = int(addr,0)
+        return np.asarray(self.RegBatch([(addr,)]*num), dtype = np.uint32)
+
+    #####################################################
+    # Asynchronous register access
+    # returns concurrent.futures.Future, asyncio code can
+    # use asyncio.wrap_future(). Synchronous methods go
+    # through the same pipeline once it is started.
+    #####################################################
+    def PipelineStart(self, executor = None, retries = 2, timeout = 5.0) :
+        if self.pipe is None :
+            self.pipe = lappdRegPipeline(self, executor, retries, timeout)
+        return self.pipe
+
+    def PipelineStop(self) :
+        if self.pipe is not None : self.pipe.Flush()
+        self.pipe = None
+
+    def RegBatchAsync(self, ops, timeout = None) :
+        if self.pipe is None : self.PipelineStart()
+        for op in ops :
+            if len(op) == 2 : self.ShadowUpdate(op[0], op[1])
+        return self.pipe.Submit(ops, timeout)
+
+    def RegReadAsync(self, addr, timeout = None) :
+        fut = concurrent.futures.Future()
+        def done(f) :
+            if f.exception() is not None : fut.set_exception(f.exception())
+            else : fut.set_result(f.result()[0])
+        self.RegBatchAsync([(addr,)], timeout).add_done_callback(done)
+        return fut
+
+    def RegWriteAsync(self, addr, value, timeout = None) :
+        return self.RegBatchAsync([(addr, value)], timeout)
+
+    # poll until (reg & mask) == value, or (reg & mask) >= value if ge,
+    # with exponential backoff. Returns the waiting time. On timeout raises
+    # TimeoutError, or returns -1 if throw is False
+    # settle : s before the first read, for status bits which still show the
+    #          previous state for a while after a change
+    def WaitReg(self, addr, mask, value, timeout = 0.1, ge = False, throw = True, settle = 0) :
+        t0 = time.time()
+        if settle > 0 : time.sleep(settle)
+        dt = 0.0001
+        while True :
+            v = self.RegRead(addr) & mask
+            if (v >= value) if ge else (v == value) : return time.time() - t0
+            tleft = timeout - (time.time() - t0)
+            if tleft <= 0 : break
+            time.sleep(min(dt, tleft))
+            dt = min(2*dt, 0.01)
+        if throw :
+            raise TimeoutError('register %s : %s & %s != %s after %.3f s' % (hex(addr), hex(v), hex(mask), hex(value), timeout))
+        return -1
+
+    # wait until the ADC buffer holds the readout window of the last trigger
+    def WaitBufReady(self, timeout = -1, throw = True) :
+        if timeout < 0 : timeout = self.BufTimeout
+        nsamples = self.RegRead(ADCBUFNUMWORDS)
+        nwords = self.AdcSampleOffset + 4*(nsamples if nsamples > 0 else 1024)
+        return self.WaitReg(ADCBUFCURADDR, 0xffffffff, nwords, timeout, ge = True, throw = throw)
+
     # modify only one bit of the register 
     def RegSetBit(self,addr, bit, bit_val) :
         if bit_val not in [0,1] :
-            raise Exception("RegSetBit:: error:: val should be 0 or 1 ", file=sys.stderr)
+            raise Exception("RegSetBit:: error:: val should be 0 or 1 ")
 
-        reg_val = self.brd.peeknow(addr)
+        if self.Shadowed(addr) and addr in self.StrobeRegs :
+            reg_val = 0
+        else :
+            reg_val = self.RegRead(addr)
         if bit_val == 1 :
             reg_val = reg_val | (1 << bit)
         else :
             reg_val = reg_val & (~(1 << bit))
-        self.brd.pokenow(addr, reg_val)
+        self.RegWrite(addr, reg_val)
+
+    #####################################################
+    # Shadow registers
+    #####################################################
+    def Shadowed(self, addr) :
+        return self.UseShadow and addr < ADDR_DAC_OFFSET and addr not in self.VolatileRegs
+
+    def ShadowUpdate(self, addr, value) :
+        if not self.Shadowed(addr) : return
+        if addr in self.StrobeRegs :
+            # logic reset : forget everything
+            if value & (1 << C_CMD_RESET_BIT) : self.shadow.clear()
+        else :
+            self.shadow[addr] = value
+
+    # reload all shadowed registers from the board
+    def ShadowResync(self) :
+        addrs = list(self.shadow.keys())
+        vals  = self.RegBatch([(a,) for a in addrs])
+        self.shadow = dict(zip(addrs, vals))
+
+    # compare shadow copy with the board, returns {addr : (shadow, board)} for mismatches
+    def ShadowVerify(self) :
+        addrs = list(self.shadow.keys())
+        vals  = self.RegBatch([(a,) for a in addrs])
+        return {a : (self.shadow[a], v) for a, v in zip(addrs, vals) if self.shadow[a] != v}
+
+    #####################################################
+    # Configuration profiles, see lappdRegMap
+    #####################################################
+
+    # profile : dict, name of LAPPD_PROFILES or json file
+    # only registers whose value changes are written, current values come
+    # from the shadow copy or from one bulk read, writes go in one batch
+    # force  : write all registers of the profile, unchanged ones too (fields
+    #          not named keep their current value, write only registers
+    #          start from their default)
+    # dryrun : compute the writes without doing them
+    # returns list of (addr, value) written
+    def ApplyProfile(self, profile, force = False, dryrun = False) :
+        if isinstance(profile, str) :
+            profile = LAPPD_PROFILES[profile] if profile in LAPPD_PROFILES else LoadProfile(profile)
+        if self.fwver < 0 : self.fwver = self.RegRead(FW_VERSION) & 0xff
+        ents, skipped = self.regmap.Resolve(profile, self.fwver)
+        if len(skipped) > 0 :
+            print('not in FW version %d : %s' % (self.fwver, ' '.join(skipped)), file=sys.stderr)
+
+        # current values : shadow, bulk read or unknown (write only, or
+        # a whole register value which is written anyway with force)
+        cur = {}
+        reads = []
+        for reg, mask, val in ents :
+            if self.Shadowed(reg.addr) and reg.addr in self.shadow : cur[reg.addr] = self.shadow[reg.addr]
+            elif reg.access == REG_WO or (force and mask == 0xffffffff) : cur.setdefault(reg.addr, None)
+            elif reg.addr not in reads : reads.append(reg.addr)
+        cur.update(zip(reads, self.RegBatch([(a,) for a in reads])))
+
+        ops = []
+        for reg, mask, val in ents :
+            old = cur[reg.addr]
+            base = old if old is not None else reg.default
+            new = (base & ~mask) | (val & mask)
+            if force or old is None or new != old : ops.append((reg.addr, new))
+            cur[reg.addr] = new
+        if not dryrun and len(ops) > 0 :
+            self.RegBatch(ops)
+            if MODE in cur : self.HwPedSub = bool(cur[MODE] & (1 << C_MODE_PEDSUB_EN_BIT))
+        return ops
+
+    # current values of the writable registers (all by default) as a profile
+    def ReadProfile(self, names = None) :
+        if self.fwver < 0 : self.fwver = self.RegRead(FW_VERSION) & 0xff
+        if names is None : names = [r.name for r in self.regmap.Writable(self.fwver) if r.access == REG_RW]
+        vals = self.RegBatch([(self.regmap[n].addr,) for n in names])
+        return dict(zip(names, vals))
 
 
     def SetAdcReg(self, nadc, reg, val):
@@ -164,7 +563,7 @@ class lappdInterface :
             raise Exception('Wrong ADC chip number : %d. Should be 0 or 1' %(nadc))
 
         # bit 10 in micaroblase addr space - select adc chip : 0 -- ADC-1, 1-- ADC-2
-        self.brd.pokenow(ADDR_ADCSPI_OFFSET | (nadc << 10) | (reg << 2), val)
+        self.RegWrite(ADDR_ADCSPI_OFFSET | (nadc << 10) | (reg << 2), val)
     
     def GetAdcReg(self, nadc, reg):
         if reg < 0 or reg > 0xff :
@@ -172,9 +571,9 @@ class lappdInterface :
         if nadc < 0 or nadc > 1 :
             raise Exception('Wrong ADC chip number : %d. Should be 0 or 1' %(nadc))
         if type(reg) != int : reg = int(reg,0)
-        self.brd.pokenow(ADDR_ADCSPI_OFFSET | (nadc << 10), 2)
-        val = self.brd.peeknow(ADDR_ADCSPI_OFFSET | (nadc << 10) | (reg << 2))
-        self.brd.pokenow(ADDR_ADCSPI_OFFSET | (nadc << 10), 0)
+        self.RegWrite(ADDR_ADCSPI_OFFSET | (nadc << 10), 2)
+        val = self.RegRead(ADDR_ADCSPI_OFFSET | (nadc << 10) | (reg << 2))
+        self.RegWrite(ADDR_ADCSPI_OFFSET | (nadc << 10), 0)
         print(hex(val), file=sys.stderr)
         return val
 
@@ -267,6 +666,7 @@ class lappdInterface :
         else :
             raise Exception('error: wrong SER_DATA_RATE value')
 
+    @Profiled
     def CalibrateIDelaysFrameAll(self) :
         frame_dly = [0,0]
         for iadc in range(0,2) :
@@ -274,13 +674,17 @@ class lappdInterface :
             frame_dly[iadc] = self.CalibrateIDelayFrame(iadc)
         for iadc in range(0,2) :
             self.RegWrite(ADCFRAMEDELAY_0 + iadc*4, frame_dly[iadc])
+        self.FrameDelays = frame_dly
+        self.Bitslips = [[], []]
         # reset bitslips for ISERDESEs on data lines
         self.RegSetBit(CMD, C_CMD_RESET_BIT, 1)
 
+    @Profiled
     def CalibrateIDelaysDataAll(self) :
         for iadc in range(0,2) :
             print("calibrate data IDELAYs for ADC #%d"%(iadc), file=sys.stderr)
-            ret = self.CalibrateIDelaysData(iadc)
+            if self.BulkRead : ret = self.CalibrateIDelaysDataFast(iadc)
+            else             : ret = self.CalibrateIDelaysData(iadc)
             self.AdcSetTestMode(iadc, 'normal')
             if not ret:
                 raise Exception('ADC calibration failed')
@@ -303,9 +707,62 @@ class lappdInterface :
             else :
                 print('One more try with bitslip %s' % (bin(bitslp)), file=sys.stderr)
                 self.RegWrite(BITSLIP+nadc*4, bitslp)
+                self.Bitslips[nadc].append(bitslp)
+        print('Failed', file=sys.stderr)
+        return False
+
+
+    # all 16 channels of the ADC at once : delays are programmed in one
+    # batch per step and test pattern samples are read in bulk
+    def CalibrateIDelaysDataFast(self, nadc) :
+        self.AdcSetTestMode(nadc, 'custom')
+        itr = 0
+        while itr < 10:
+            good = self.ScanIDelaysData(nadc)
+            first, last = EyeWindows(good)
+            best = (first + last) // 2
+            for chn in range(16) :
+                if first[chn] != -1 :
+                    print("Channel %d : dly_good_first = %d dly_good_last = %d best = %d" 
+                        % (chn, first[chn], last[chn], best[chn]), file=sys.stderr)
+                else :
+                    print('No delay found for channel %d' % (chn), file=sys.stderr)
+            self.RegBatch([(ADCDATADELAY_0 + 16*nadc*4 + 4*chn, int(best[chn]))
+                                  for chn in range(16) if first[chn] != -1])
+            self.IDelayWindows[nadc] = np.stack((first, last))
+            self.DataDelays[nadc] = np.where(first != -1, best, -1)
+            bitslp = int(np.sum((first == -1) << np.arange(16)))
+            itr = itr + 1
+            if bitslp == 0 : 
+                print('Calibration OK', file=sys.stderr)
+                self.AdcSetTestMode(nadc, 'normal')
+                return True
+            else :
+                print('One more try with bitslip %s' % (bin(bitslp)), file=sys.stderr)
+                self.RegWrite(BITSLIP+nadc*4, bitslp)
+                self.Bitslips[nadc].append(bitslp)
         print('Failed', file=sys.stderr)
         return False
 
+    # returns bool array (nchans, 32) : test pattern seen at each data delay
+    def ScanIDelaysData(self, nadc, chans = range(16)) :
+        chans = list(chans)
+        dbgchans = [nadc*32 + chn*2 for chn in chans]
+        self.AdcSetTestPat(nadc, self.TestPattern[0])
+        good = np.zeros((len(chans), 0x20), dtype = bool)
+        for dly in range(0,0x20) :
+            self.RegBatch([(ADCDATADELAY_0 + 16*nadc*4 + 4*chn, dly) for chn in chans])
+            v = self.ReadDebugSamples(dbgchans, self.NCalSamples)
+            good[:, dly] = np.all(v == self.TestPattern[0], axis = 1)
+        return good
+
+    # nsamples of ADCDEBUG1 for each debug channel, shape (len(dbgchans), nsamples)
+    def ReadDebugSamples(self, dbgchans, nsamples) :
+        ops = []
+        for ch in dbgchans :
+            ops += [(ADCDEBUGCHAN, ch)] + [(ADCDEBUG1,)]*nsamples
+        v = self.RegBatch(ops)
+        return np.asarray(v, dtype = np.uint32).reshape(len(dbgchans), nsamples)
 
     def CalibrateIDelaySingle(self, nadc, chn):
         self.RegWrite(ADCDEBUGCHAN, nadc*32 + chn*2) 
@@ -324,11 +781,100 @@ class lappdInterface :
             print("Channel %d : dly_good_first = %d dly_good_last = %d best = %d" 
                 % (chn, dly_good_first, dly_good_last, dly_best), file=sys.stderr)
             self.RegWrite(ADCDATADELAY_0 + 16*nadc*4 + 4*chn, dly_best)
+            if self.DataDelays[nadc] is None : self.DataDelays[nadc] = np.full(16, -1)
+            self.DataDelays[nadc][chn] = dly_best
             return True
         else:
             print('No delay found for channel %d' % (chn), file=sys.stderr)
             return False
 
+    #####################################################
+    # Calibration cache
+    # {board key : {time, frame, data, bitslip}} in a json file,
+    # bitslip : masks written per ADC, every write slips once more
+    #####################################################
+
+    # DNA and firmware version identify board and calibration
+    def CalibKey(self) :
+        dna = (self.RegRead(DEVICEDNA_H) << 32) | self.RegRead(DEVICEDNA_L)
+        return '%016x_%08x' % (dna, self.RegRead(FW_VERSION))
+
+    # boards of a crate save concurrently into the same file : the update is
+    # serialized and the temporary file is private to the process and thread
+    def SaveCalib(self, fname) :
+        if any(d is None for d in self.DataDelays) :
+            raise Exception('no data IDELAY calibration to save')
+        ent = {
+            'time'    : time.time(),
+            'frame'   : [None if d is None else int(d) for d in self.FrameDelays],
+            'data'    : [[int(d) for d in dd] for dd in self.DataDelays],
+            'bitslip' : [[int(b) for b in bb] for bb in self.Bitslips]
+        }
+        key = self.CalibKey()
+        tmp = '%s.%d.%d.tmp' % (fname, os.getpid(), threading.get_ident())
+        with _calib_lock :
+            cache = {}
+            if os.path.exists(fname) :
+                with open(fname) as f : cache = json.load(f)
+            cache[key] = ent
+            with open(tmp, 'w') as f : json.dump(cache, f, indent = 1)
+            os.replace(tmp, fname)
+
+    # program cached delays and bitslips and verify them
+    # returns False if there is no valid entry or verification failed
+    @Profiled
+    def RestoreCalib(self, fname) :
+        if not os.path.exists(fname) : return False
+        with open(fname) as f : cache = json.load(f)
+        key = self.CalibKey()
+        ent = cache.get(key)
+        if ent is None :
+            print('No cached calibration for %s' % (key), file=sys.stderr)
+            return False
+        if time.time() - ent['time'] > self.CalMaxAge :
+            print('Cached calibration for %s is stale' % (key), file=sys.stderr)
+            return False
+
+        if all(d is not None for d in ent['frame']) :
+            for iadc in range(0,2) :
+                self.RegWrite(ADCFRAMEDELAY_0 + iadc*4, ent['frame'][iadc])
+            # reset bitslips for ISERDESEs on data lines
+            self.RegSetBit(CMD, C_CMD_RESET_BIT, 1)
+        # bitslip writes are pulses : all of them are replayed in order
+        bitslips = [bb if isinstance(bb, list) else [bb] if bb != 0 else [] for bb in ent['bitslip']]
+        ops = []
+        for iadc in range(0,2) :
+            ops += [(ADCDATADELAY_0 + 16*iadc*4 + 4*chn, d) for chn, d in enumerate(ent['data'][iadc]) if d >= 0]
+            ops += [(BITSLIP + iadc*4, b) for b in bitslips[iadc]]
+        self.RegBatch(ops)
+
+        self.FrameDelays = ent['frame']
+        self.DataDelays  = [np.array(dd) for dd in ent['data']]
+        self.Bitslips    = bitslips
+        if not self.VerifyCalib() :
+            print('Cached calibration for %s failed verification' % (key), file=sys.stderr)
+            return False
+        print('Calibration restored from cache', file=sys.stderr)
+        return True
+
+    # a few test pattern probes on every data channel of both ADCs
+    def VerifyCalib(self) :
+        ok = True
+        for iadc in range(0,2) :
+            # frame lock needs time to settle after the frame delay was written
+            if all(d is not None for d in self.FrameDelays) and \
+               self.WaitReg(STATUS, 1 << iadc, 1 << iadc, self.FrameTimeout, throw = False,
+                            settle = self.FrameSettle) < 0 :
+                ok = False
+            self.AdcSetTestMode(iadc, 'custom')
+            dbgchans = [iadc*32 + chn*2 for chn in range(16)]
+            for pattern in self.TestPattern :
+                self.AdcSetTestPat(iadc, pattern)
+                v = self.ReadDebugSamples(dbgchans, self.CalNProbes)
+                if not np.all(v == pattern) : ok = False
+            self.AdcSetTestMode(iadc, 'normal')
+        return ok
+
     def CalibrateIDelayFrame(self, nadc):
         dly_good_first = -1
         dly_good_last  = -1
@@ -337,9 +883,9 @@ class lappdInterface :
         dly_prev_bad = False
         for dly in range(0,0x20) :
             self.RegWrite(ADCFRAMEDELAY_0+nadc*4, dly)
-            time.sleep(0.01)
-            sta = self.RegRead(STATUS) & (1 << nadc)
-            if sta != 0 :
+            sta = self.WaitReg(STATUS, 1 << nadc, 1 << nadc, self.FrameTimeout, throw = False,
+                               settle = self.FrameSettle)
+            if sta >= 0 :
                 if dly_prev_bad : i = i + 1
                 if len(dly_seqs) < i+1 :
                     dly_seqs.append([])
@@ -390,45 +936,92 @@ class lappdInterface :
     def AdcBufStop(self) :
         self.RegSetBit(MODE,C_MODE_ADCBUF_WREN_BIT,0)
             
-    def ReadMem(self, start_addr, num_words, chan = -1, fname = "") :
-        ret_val = []
+    # read raw ADC buffer words as np.uint32 array
+    def ReadMemRaw(self, num_words, chan = -1) :
         self.AdcBufStop();
         
         if chan != -1 :
-            if not self.SetDebugChan(chan) : return -1
-
-        if fname != "" : filo = open(fname,"w+")
+            if not self.SetDebugChan(chan) : return None
 
-        addr = ADDR_ADCBUF_OFFSET + (1<<2)
-        v = self.RegRead(addr)
-        
-        for i in range(0,num_words):
-            # FIXME use multiple peek followed by transfer
-            # addr = ADDR_ADCBUF_OFFSET + ((start_addr + i)<<2)
-            addr = ADDR_ADCBUF_OFFSET 
-            rv = self.RegRead(addr)
-            v  = rv >> 4
-            f  = rv & 0xf
-            # convert two's compliment to signed int
-            if f == 0 : 
-              if v & (1<<11) != 0 : v = v - 0xfff - 1
-            else : 
-              if f == 1 : 
-                v = -9999
-              else : 
-                v = 9999
-              
-            ret_val.append(v)
-            if fname != "" : filo.write("%d %d\n" % (i, v))
+        # dummy read before buffer readout
+        self.RegRead(ADDR_ADCBUF_OFFSET + (1<<2))
+        return self.RegReadBlock(ADDR_ADCBUF_OFFSET, num_words)
+            
+    # decoded ADC buffer words as np.int16 array
+    @Profiled
+    def ReadMemArr(self, start_addr, num_words, chan = -1, fname = "") :
+        raw = self.ReadMemRaw(num_words, chan)
+        if raw is None : return None
+        v = DecodeAdcWords(raw)
+        if fname != "" :
+            np.savetxt(fname, np.column_stack((np.arange(num_words), v)), fmt = "%d")
         #self.AdcBufStart()
-        return ret_val 
+        return v
+
+    def ReadMem(self, start_addr, num_words, chan = -1, fname = "") :
+        v = self.ReadMemArr(start_addr, num_words, chan, fname)
+        if v is None : return -1
+        return v.tolist()
+
+    # pedestal subtracted waveform as np.int16 array
+    def ReadWfArr(self) :
+        raw = self.ReadMemArr(0, 4200, self.WfChan)
+        wf  = ExtractSamples(raw, self.AdcSampleOffset)
+        if self.HwPedSub : return wf
+        # ADC underflow/overflow flags are kept as they are
+        return np.where(np.abs(wf) >= ADC_OVERFLOW, wf, wf - np.asarray(self.peds).astype(np.int16))
 
     def ReadWf(self) :
-        raw = self.ReadMem(0, 4200, 15)
-        wf  = [0]*1024
-        for isa in range(0,1024):
-            wf[isa] = raw[self.AdcSampleOffset + 4*isa] - int(self.peds[isa])
-        return wf
+        return self.ReadWfArr().tolist()
+
+    # pedestal subtracted waveforms of several channels, np.int16 (nchans, nsamples)
+    # chans : channel list, enabled channels (ADCCHANMASK) by default
+    # nsamples follows ADCBUFNUMWORDS : 1024 in ROI mode, more in FULL mode
+    def ReadWfs(self, chans = None) :
+        if chans is None : chans = self.GetChanMask()
+        raw, nsamples = self.ReadWfsRaw(chans)
+        return self.DecodeWfs(raw, chans, nsamples)
+
+    # raw buffer words of several channels, np.uint32 (nchans, nwords), and nsamples
+    @Profiled
+    def ReadWfsRaw(self, chans) :
+        chans = list(chans)
+        nsamples = self.RegRead(ADCBUFNUMWORDS)
+        if nsamples <= 0 : nsamples = 1024
+        nwords = max(4200, self.AdcSampleOffset + 4*nsamples)
+
+        # each channel read once : debug channel switch, dummy read and the
+        # whole buffer, all queued into as few transfers as possible
+        plan = self.ReadoutPlan(chans)
+        self.AdcBufStop()
+        ops = []
+        for ch in plan :
+            ops += [(ADCDEBUGCHAN, ch), (ADDR_ADCBUF_OFFSET + (1<<2),)] + [(ADDR_ADCBUF_OFFSET,)]*nwords
+        raw = np.asarray(self.RegBatch(ops), dtype = np.uint32).reshape(len(plan), nwords + 1)[:, 1:]
+        return raw[[plan.index(ch) for ch in chans]], nsamples
+
+    def DecodeWfs(self, raw, chans, nsamples = 1024) :
+        wfs = ExtractSamples(DecodeAdcWords(raw), self.AdcSampleOffset, nsamples)
+        if self.HwPedSub : return wfs
+        return np.where(np.abs(wfs) >= ADC_OVERFLOW, wfs, wfs - self.PedRows(chans, nsamples))
+
+    # distinct channels in readout order
+    def ReadoutPlan(self, chans) :
+        for ch in chans :
+            if ch < 0 or ch > 63 : raise Exception('wrong channel number : %d' % (ch))
+        return sorted(set(chans))
+
+    # pedestals of chans as np.int16 (nchans, nsamples), cells wrap around
+    # every 1024 samples, channels without pedestals get 0
+    def PedRows(self, chans, nsamples = 1024) :
+        peds = np.zeros((len(chans), nsamples), dtype = np.int16)
+        if self.pedtab is None : return peds
+        mean = self.pedtab.Mean()
+        for i, ch in enumerate(chans) :
+            if ch in self.pedtab.chans :
+                peds[i] = np.resize(mean[self.pedtab.Index(ch)].astype(np.int16), nsamples)
+        return peds
+
     #####################################################
     # DAC configuration
     #####################################################
@@ -448,6 +1041,10 @@ class lappdInterface :
 
     # set output voltage
     def DacSetVout(self, dac_chn, vout):
+        self.RegWrite(*self.DacVoutOp(dac_chn, vout))
+
+    # register write (addr, value) setting the output voltage
+    def DacVoutOp(self, dac_chn, vout):
 
         if type(dac_chn) == int :
             dac_chn_i = dac_chn
@@ -462,7 +1059,7 @@ class lappdInterface :
         addr = ADDR_DAC_OFFSET | ((8 | dac_chn_i)<<2)
         val  = self.GetDacCode(vout)
         print('DAC out: %d addr: %s voltage: %f code: %s' % (dac_chn_i, hex(addr), vout, hex(val)), file=sys.stderr)
-        self.RegWrite(addr, val)
+        return (addr, val)
 
     # set all voltages to operating values
     def DacSetAll(self):
@@ -471,12 +1068,15 @@ class lappdInterface :
         self.DacIni()
 
         # set output voltages TODO: don't hardcode values here
-        self.DacSetVout(0,0.7)   # BIAS
-        self.DacSetVout(1,1.0)  # ROFS
-        self.DacSetVout(2,1.3)   # OOFS
-        self.DacSetVout(3,0.7) # CMOFS
-        self.DacSetVout(4,0.5) #TCAL_N1
-        self.DacSetVout(5,0.5) #TCAL_N2
+        # sent as one batch, order is kept
+        self.RegBatch([
+            self.DacVoutOp(0,0.7),   # BIAS
+            self.DacVoutOp(1,1.0),  # ROFS
+            self.DacVoutOp(2,1.3),   # OOFS
+            self.DacVoutOp(3,0.7), # CMOFS
+            self.DacVoutOp(4,0.5), #TCAL_N1
+            self.DacVoutOp(5,0.5) #TCAL_N2
+        ])
         
 
     # set all voltages to 0
@@ -502,6 +1102,68 @@ class lappdInterface :
     def DrsTimeCalibOscOff(self):
         self.RegSetBit(MODE, C_MODE_TCA_ENA_BIT, 0)
 
+    # stop cell of each DRS4 chip (8 channels per chip), chip order is
+    # reversed by the firmware if C_MODE_DRS_REVRS_BIT is set
+    def ReadStopSamples(self) :
+        v = self.RegBatch([(MODE,)] + [(DRSSTOPSAMPLE_0 + 4*i,) for i in range(8)])
+        stops = np.asarray(v[1:], dtype = np.int64) & 0x3ff
+        if v[0] & (1 << C_MODE_DRS_REVRS_BIT) : stops = stops[::-1]
+        return stops
+
+    # stop cell of every channel in chans
+    def StopCells(self, chans) :
+        return self.ReadStopSamples()[np.asarray(chans) // 8]
+
+    # nev triggered events : waveforms (nev, nchans, nsamples) and stop cells (nev, nchans)
+    def AcquireEvents(self, nev, chans) :
+        wfs, stops = [], []
+        for i in range(nev) :
+            self.AdcBufStart()
+            self.SoftTrigger()
+            self.WaitBufReady()
+            stops.append(self.StopCells(chans))
+            wfs.append(self.ReadWfs(chans))
+        return np.stack(wfs), np.stack(stops)
+
+    # cell widths from nev events of the time calibration oscillator
+    # period : TCA period, the widths are in the same unit
+    @Profiled
+    def CalibrateTiming(self, nev = 100, chans = None, period = 10.0) :
+        if chans is None : chans = self.GetChanMask()
+        if len(chans) == 0 : chans = [self.WfChan]
+        tcal = lappdTimeCalib(chans, period)
+        self.RegSetBit(MODE, C_MODE_DRS_DENABLE_BIT, 1)
+        self.DrsTimeCalibOscOn()
+        try :
+            # acquisition in blocks, crossings are found on the whole block at once
+            for i0 in range(0, nev, 50) :
+                wfs, stops = self.AcquireEvents(min(50, nev - i0), chans)
+                tcal.Add(wfs, stops)
+        finally :
+            self.DrsTimeCalibOscOff()
+        tcal.Solve()
+        self.timecal = tcal
+        for ich, ch in enumerate(chans) :
+            print('channel %d : mean width %.4f rms %.4f residual %.4f' % (ch, tcal.widths[ich].mean(),
+                  tcal.widths[ich].std(), tcal.resid[ich]), file=sys.stderr)
+        return tcal
+
+    def SaveTiming(self, fname) :
+        self.timecal.Save(fname)
+
+    def LoadTiming(self, fname) :
+        self.timecal = lappdTimeCalib.Load(fname)
+
+    # sample times and pedestal subtracted waveforms of chans for the
+    # current buffer, both (nchans, nsamples), see lappdTimeCalib.Apply
+    def ReadWfsTimed(self, chans = None, cellorder = False) :
+        if chans is None : chans = self.GetChanMask()
+        if self.timecal is None : raise Exception('no timing calibration')
+        rows  = [self.timecal.Index(ch) for ch in chans]
+        stops = self.StopCells(chans)
+        wfs   = self.ReadWfs(chans)
+        return self.timecal.Apply(wfs, stops, cellorder, rows)
+
     def SetDebugChan(self, chan) :
         if chan < 0 or chan > 64 :
             raise Exception('wrong channel number')
@@ -509,37 +1171,183 @@ class lappdInterface :
         self.RegWrite(ADCDEBUGCHAN,chan)
         return True
 
-    def MeasurePeds(self, nev = 5):
+    # software trigger : start DRS readout sequence
+    def SoftTrigger(self) :
+        self.RegWrite(CMD, 1 << C_CMD_READREQ_BIT)
+
+    #####################################################
+    # Event builder UDP stream
+    #####################################################
+
+    # register values by name, see SNAPSHOT_REGS
+    def RegSnapshot(self) :
+        return {name : self.RegRead(addr) for name, addr in SNAPSHOT_REGS}
+
+    # enabled channels from ADCCHANMASK registers (32 channels per register)
+    def GetChanMask(self) :
+        chans = []
+        for ireg in range(2) :
+            m = self.RegRead(ADCCHANMASK_0 + 4*ireg)
+            chans += [32*ireg + b for b in range(32) if m & (1 << b)]
+        return chans
+
+    # configure destination of the event stream, returns list of UDP ports to listen on
+    # ip   : '10.0.6.1', mac : 'aa:bb:cc:dd:ee:ff'
+    def SetEventDest(self, ip, mac, dport = 8990, sport = 8990, nports = 1, nsamp_packet = 512, fragment = True) :
+        if nports < 1 :
+            raise Exception('wrong number of UDP ports : %d' % (nports))
+        macv = int(mac.replace(':','').replace('-',''), 16)
+        self.RegWrite(DESTMAC_LOW , macv & 0xffffffff)
+        self.RegWrite(DESTMAC_HIGH, macv >> 32)
+        self.RegWrite(DESTIP, int.from_bytes(socket.inet_aton(ip), 'big'))
+        self.RegWrite(NBIC_PORTS, (sport & 0xffff) | ((dport & 0xffff) << 16))
+        self.RegWrite(NUDPPORTS, nports)
+        self.RegWrite(NSAMPLEPACKET, nsamp_packet)
+        self.RegSetBit(MODE, C_MODE_EB_FRDISABLE_BIT, 0 if fragment else 1)
+        print('Event stream to %s (%s) ports %d..%d' % (ip, mac, dport, dport+nports-1), file=sys.stderr)
+        return list(range(dport, dport + nports))
+
+    # pedestal mean and RMS per cell for chans (enabled channels by default)
+    # reject : outlier rejection in units of RMS, 0 to switch off
+    @Profiled
+    def MeasurePeds(self, nev = 5, chans = None, reject = 0):
         self.RegSetBit(MODE, C_MODE_DRS_DENABLE_BIT,1)
         self.RegSetBit(MODE, C_MODE_DRS_TRANS_BIT,1)
 
-        bufs = [[0]*5 for i in range(1024)]
+        if chans is None : chans = self.GetChanMask()
+        if len(chans) == 0 : chans = [self.WfChan]
+        peds = lappdPedestals(chans)
+
+        # raw pedestals : firmware pedestal subtraction (PedMemUpload) and
+        # zero suppression are off while measuring, restored afterwards
+        bits = (1 << C_MODE_PEDSUB_EN_BIT) | (1 << C_MODE_ZERSUP_EN_BIT)
+        mode, hwpedsub = self.RegRead(MODE), self.HwPedSub
+        if mode & bits : self.RegWrite(MODE, mode & ~bits)
+        self.HwPedSub = False
+        try :
+            for i in range(nev) :
+                if i % 100 == 0 : print('pedestal event %d' % (i), file=sys.stderr)
+                # one trigger per event, all channels read from the same buffer
+                self.AdcBufStart()
+                self.SoftTrigger()
+                self.WaitBufReady()
+                raw = self.ReadWfsRaw(chans)[0]
+                peds.Add(ExtractSamples(DecodeAdcWords(raw), self.AdcSampleOffset, peds.ncells), reject)
+        finally :
+            if mode & bits : self.RegWrite(MODE, (self.RegRead(MODE) & ~bits) | (mode & bits))
+            self.HwPedSub = hwpedsub
+
+        self.SetPeds(peds)
+        rms = peds.Rms()
+        for ich, ch in enumerate(chans) :
+            print('channel %d : mean pedestal %.1f mean RMS %.2f' % (ch, peds.mean[ich].mean(), rms[ich].mean()), file=sys.stderr)
+        return peds
+
+    # use pedestal table, peds/rmss follow the waveform channel
+    def SetPeds(self, peds) :
+        self.pedtab = peds
+        ich = peds.Index(self.WfChan) if self.WfChan in peds.chans else 0
+        self.peds = peds.Mean()[ich]
+        self.rmss = peds.Rms()[ich]
+
+    def SavePeds(self, fname) :
+        self.pedtab.Save(fname)
+
+    def LoadPeds(self, fname) :
+        self.SetPeds(lappdPedestals.Load(fname))
 
-        for i in range(nev) :
-            print(i, file=sys.stderr)
-            self.RegSetBit(CMD, C_CMD_READREQ_BIT, 1)
-            time.sleep(0.001)
-            v = self.ReadMem(0,4200,15)
-            # print(v)
-            for isample in range(0,1024) :
-                bufs[isample][i] = v[self.AdcSampleOffset + 4*isample]
-        
-        print(bufs, file=sys.stderr)
 
-        for isa in range(0,1024):
-            buf = bufs[isa]
-            mean = np.around(np.mean(buf),1)
-            bufx = [(a - mean) for a in bufs[isa]]
-            rms = np.around(np.sqrt(np.mean(np.square(bufx))),1)
-            self.peds[isa] = mean
-            self.rmss[isa] = rms
-        #print(self.peds)
-        print(self.rmss, file=sys.stderr)
-        return 
+    #####################################################
+    # Firmware pedestal subtraction
+    #####################################################
+
+    # write the pedestal table into pedestal memory, check it and
+    # switch on subtraction in the firmware
+    @Profiled
+    def PedMemUpload(self, peds = None, verify = True, enable = True) :
+        if peds is None : peds = self.pedtab
+        if peds is None :
+            raise Exception('no pedestals to upload, run MeasurePeds first')
+        words = np.rint(peds.Mean()).astype(np.int64) & PEDMEM_MASK
+        ops = []
+        for ich, ch in enumerate(peds.chans) :
+            ops += [(PedMemAddr(ch, cell), int(w)) for cell, w in enumerate(words[ich])]
+        t0 = time.time()
+        self.RegBatch(ops)
+        print('pedestals for %d channels uploaded in %.2f s' % (len(peds.chans), time.time() - t0), file=sys.stderr)
+        if verify :
+            rb = self.PedMemRead(peds.chans)
+            crc_exp = zlib.crc32(words.astype(np.uint32).tobytes())
+            crc_rb  = zlib.crc32(rb.tobytes())
+            if crc_exp != crc_rb :
+                nbad = int(np.sum(rb != words))
+                raise Exception('pedestal memory check failed : crc %08x != %08x, %d bad cells' % (crc_rb, crc_exp, nbad))
+        if enable : self.PedSubEnable(1)
+
+    # pedestal memory content for chans, np.uint32 (nchans, 1024)
+    def PedMemRead(self, chans) :
+        ops = [(PedMemAddr(ch, cell),) for ch in chans for cell in range(PEDMEM_NCELLS)]
+        rb = np.asarray(self.RegBatch(ops), dtype = np.uint32)
+        return rb.reshape(len(chans), PEDMEM_NCELLS) & PEDMEM_MASK
+
+    def PedSubEnable(self, on) :
+        self.RegSetBit(MODE, C_MODE_PEDSUB_EN_BIT, on)
+        self.HwPedSub = bool(on)
 
+    #####################################################
+    # Zero suppression
+    #####################################################
 
-    def Initialize(self, doCal = True):
+    # per channel thresholds k * (mean cell RMS) from the pedestal table
+    def ZeroSupThresholds(self, k = 5.0, peds = None) :
+        if peds is None : peds = self.pedtab
+        if peds is None :
+            raise Exception('no pedestals for zero suppression thresholds, run MeasurePeds first')
+        rms = peds.Rms().mean(axis = 1)
+        return {ch : int(np.ceil(k * r)) for ch, r in zip(peds.chans, rms)}
+
+    # thresholds : {chan : threshold in ADC counts}
+    def ZeroSupSet(self, thresholds) :
+        for ch in thresholds :
+            if ch < 0 or ch > 63 : raise Exception('wrong channel number : %d' % (ch))
+        self.RegBatch([(ZEROTHRESH_0 + 4*ch, thr) for ch, thr in thresholds.items()])
+        self.zsthr = dict(thresholds)
+
+    def ZeroSupEnable(self, on) :
+        self.RegSetBit(MODE, C_MODE_ZERSUP_EN_BIT, on)
+
+    # program k*RMS thresholds and enable zero suppression
+    # rx : optional event stream receiver (lappdRx), used to measure the
+    #      data volume of nev software triggers before and after
+    def ZeroSupTune(self, k = 5.0, rx = None, nev = 10) :
+        thr = self.ZeroSupThresholds(k)
+        self.ZeroSupSet(thr)
+        if rx is None :
+            self.ZeroSupEnable(1)
+            return thr, None
+        self.ZeroSupEnable(0)
+        before = self.StreamBytesPerTrigger(rx, nev)
+        self.ZeroSupEnable(1)
+        after  = self.StreamBytesPerTrigger(rx, nev)
+        print('zero suppression k = %.1f : %.0f -> %.0f bytes per trigger (x%.1f)'
+              % (k, before, after, before / max(after, 1)), file=sys.stderr)
+        return thr, (before, after)
+
+    # mean event stream volume per software trigger
+    def StreamBytesPerTrigger(self, rx, nev = 10, settle = 0.1) :
+        n0 = rx.builder.nBytes
+        for i in range(nev) :
+            self.SoftTrigger()
+            rx.Poll(0.001)
+        t0 = time.time()
+        while time.time() - t0 < settle : rx.Poll(0.01)
+        return (rx.builder.nBytes - n0) / nev
+
+    # calFile : calibration cache, restore cached IDELAYs instead of a full scan
+    @Profiled
+    def Initialize(self, doCal = True, calFile = ""):
         fwver = self.RegRead(FW_VERSION) & 0xff
+        self.fwver = fwver
         
         print('FW version : %d' % (fwver), file=sys.stderr)
 
@@ -562,45 +1370,42 @@ class lappdInterface :
         self.DacSetAll()
 
 
-        if fwver >= 100 and doCal : self.CalibrateIDelaysFrameAll()
-        if doCal : self.CalibrateIDelaysDataAll()
-
-        self.RegWrite(DRSREFCLKRATIO, self.drsrefclk)
-        # print("DRSREFCLKRATIO : %d" % (self.drsrefclk), file=sys.stderr)
+        if doCal and (calFile == "" or not self.RestoreCalib(calFile)) :
+            if fwver >= 100 : self.CalibrateIDelaysFrameAll()
+            self.CalibrateIDelaysDataAll()
+            if calFile != "" : self.SaveCalib(calFile)
 
-        # initialize DRS-4 chips 
-        self.DrsSetConfigReg()
-        # enable DRS-4 transparent mode
-        self.RegSetBit(MODE, C_MODE_DRS_TRANS_BIT, 1)
+        # DRS4 : reference clock, configuration, transparent mode and DENABLE
+        self.ApplyProfile({'DRSREFCLKRATIO' : self.drsrefclk,
+                           'DRSCFG'         : 0b11111111,
+                           'MODE'           : {'DRS_TRANS' : 1, 'DRS_DENABLE' : 1}})
         print('DRS4 transparent mode is ON', file=sys.stderr)
-        # set DENABLE
-        self.RegSetBit(MODE, C_MODE_DRS_DENABLE_BIT, 1)
         print('DENABLE is ON', file=sys.stderr)
 
-        time.sleep(0.01)
+        tlck = self.WaitReg(DRSPLLLCK, 0xff, 0xff, self.PllTimeout, throw = False)
         pll = self.RegRead(DRSPLLLCK) & 0xff
+        self.pll = pll
 
         if pll != 0xff : 
-            print('error:: DRS4 PLL failed to lock : %s' % (bin(pll)), file=sys.stderr)
+            print('error:: DRS4 PLL failed to lock within %.3f s : %s' % (self.PllTimeout, bin(pll)), file=sys.stderr)
         else : 
-            print('DRS4 PLL locked', file=sys.stderr)
+            print('DRS4 PLL locked after %.3f s' % (tlck), file=sys.stderr)
 
         # tune SRCLK to ADCCLK phase
         if fwver >= 100 :
-            self.RegWrite(DRSVALIDDELAY, 36) # for the first sample extended
-            self.RegWrite(DRSWAITADDR, 12) 
+            prof = {'DRSVALIDDELAY' : 36, # for the first sample extended
+                    'DRSWAITADDR'   : 12}
         else :
             # remove this once new version is stable
-            self.RegWrite(DRSREFCLKRATIO, self.drsrefclk)
-            self.RegWrite(DRSVALIDDELAY,44)
-            self.RegWrite(NSAMPLEPACKET, 512) # number of words in packet
+            prof = {'DRSVALIDDELAY' : 44,
+                    'NSAMPLEPACKET' : 512} # number of words in packet
 
         # ROI readout mode
-        self.RegWrite(ADCBUFNUMWORDS,1024)
+        prof['ADCBUFNUMWORDS'] = 1024
+        prof['ADCCHANMASK_0']  = self.mask_adc1
+        prof['ADCCHANMASK_1']  = self.mask_adc2
+        self.ApplyProfile(prof)
         print('ROI readout mode', file=sys.stderr)
-        
-        self.RegWrite(ADCCHANMASK_0  , self.mask_adc1)
-        self.RegWrite(ADCCHANMASK_0+4, self.mask_adc2)
 
         print("ADC1 mask: %s ADC2 mask: %s" % (bin(self.mask_adc1), bin(self.mask_adc2)), file=sys.stderr)
 
@@ -613,4 +1418,123 @@ class lappdInterface :
         
 
 
+#####################################################
+# Register transaction pipeline
+#
+# transactions submitted from any thread are queued per
+# board and sent by a worker of a shared thread pool,
+# consecutive submissions are merged into one transfer.
+# At most one worker serves a board at a time, so many
+# boards can share a few threads.
+#####################################################
+_pipeline_executor = None
+
+def PipelineExecutor(nworkers = 8) :
+    global _pipeline_executor
+    if _pipeline_executor is None :
+        _pipeline_executor = concurrent.futures.ThreadPoolExecutor(nworkers)
+    return _pipeline_executor
+
+class lappdRegPipeline :
+    def __init__(self, ifc, executor = None, retries = 2, timeout = 5.0) :
+        self.ifc      = ifc
+        self.executor = executor if executor is not None else PipelineExecutor()
+        self.retries  = retries
+        self.timeout  = timeout # s, default for synchronous calls
+        self.queue    = collections.deque()
+        self.lock     = threading.Lock()
+        self.idle     = threading.Event()
+        self.idle.set()
+        self.busy     = False
+        self.worker   = None # thread draining the queue
+        self.nTransfers = 0
+        self.nRetries   = 0
+        self.nTimeouts  = 0
+
+    # timeout : s, transaction fails if it could not be sent within that time
+    def Submit(self, ops, timeout = None) :
+        fut = concurrent.futures.Future()
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.lock :
+            self.queue.append((ops, fut, deadline))
+            if not self.busy :
+                self.busy = True
+                self.idle.clear()
+                self.executor.submit(self._Drain)
+        return fut
+
+    def Call(self, ops) :
+        if threading.get_ident() != self.worker :
+            return self.Submit(ops, self.timeout).result(self.timeout)
+        # from a done callback, which runs on the worker : no other worker
+        # starts while this one is busy, so the queue is sent from here, in order
+        fut = self.Submit(ops)
+        while not fut.done() :
+            items = self._Take(False)
+            if items is None : break
+            self._Send(items)
+        return fut.result(0)
+
+    # wait until everything submitted so far is done
+    def Flush(self) :
+        self.idle.wait()
+
+    # next transactions to send in one transfer, None if the queue is empty
+    # release : the pipeline becomes idle when the queue is empty
+    def _Take(self, release) :
+        with self.lock :
+            if len(self.queue) == 0 :
+                if release :
+                    self.worker = None
+                    self.busy = False
+                    self.idle.set()
+                return None
+            items = [self.queue.popleft()]
+            nops  = len(items[0][0])
+            while len(self.queue) and nops + len(self.queue[0][0]) <= self.ifc.ReadBatchSize :
+                items.append(self.queue.popleft())
+                nops += len(items[-1][0])
+        return items
+
+    def _Drain(self) :
+        self.worker = threading.get_ident()
+        while True :
+            items = self._Take(True)
+            if items is None : return
+            self._Send(items)
+
+    def _Send(self, items) :
+        now = time.time()
+        live = []
+        for ops, fut, deadline in items :
+            if not fut.set_running_or_notify_cancel() : continue
+            if deadline is not None and now > deadline :
+                self.nTimeouts += 1
+                fut.set_exception(TimeoutError('register transaction timed out'))
+                continue
+            live.append((ops, fut))
+        if len(live) == 0 : return
+
+        ops = [op for item in live for op in item[0]]
+        # FIFO reads and command pulses must not be repeated
+        retries = self.retries
+        for op in ops :
+            if op[0] in self.ifc.StrobeRegs or (op[0] & ~0x3ffff) == ADDR_ADCBUF_OFFSET : retries = 0
+        for itry in range(retries + 1) :
+            try :
+                rd = self.ifc.BrdBatch(ops)
+                break
+            except Exception as e :
+                err = e
+                if itry < retries : self.nRetries += 1
+        else :
+            for item in live : item[1].set_exception(err)
+            return
+        self.nTransfers += 1
 
+        # match read values to the submitting transactions
+        i = 0
+        for ops, fut in live :
+            nrd = sum(1 for op in ops if len(op) == 1)
+            fut.set_result(rd[i : i + nrd])
+            i += nrd
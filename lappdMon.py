@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import queue
+import threading
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+#####################################################
+# Online monitoring
+#
+# lappdMonitor fills per channel histograms from the
+# events of the acquisition (no extra board access) and
+# publishes them to a shared memory block, any number of
+# lappdMonView processes read consistent snapshots
+#
+#   mon = lappdMonitor(chans, 'lappd_mon')
+#   mon.Attach(rc)            # lappdRun.lappdRunControl
+#   rc.Run(nev)
+#
+#   view = lappdMonView('lappd_mon') # other process
+#   snap = view.Snapshot()
+#
+# updates are guarded by a sequence counter (odd while
+# writing), readers retry a copy made during an update
+#####################################################
+MON_MAGIC   = 0x4c4d4f4e # 'LMON'
+MON_VERSION = 1
+MON_HISTS   = ['ped', 'rms', 'amp'] # baseline, baseline RMS, pulse amplitude per event
+MON_RANGES  = {'ped' : (-100, 100), 'rms' : (0, 20), 'amp' : (0, 2048)}
+MON_RATES   = ['time', 'triggers', 'events', 'ext_triggers'] # rate history columns
+
+# header words
+MON_H_MAGIC, MON_H_VERSION, MON_H_SEQ, MON_H_NCHANS, MON_H_NBINS, MON_H_NRATE, \
+MON_H_UPDATES, MON_H_EVENTS, MON_H_DROPPED, MON_H_RATEPOS, MON_H_PID, MON_H_TRACKER = range(12)
+MON_NHDR = 16
+
+# (name, dtype, shape) of the arrays following the header
+def MonLayout(nchans, nbins, nrate) :
+    return [
+        ('chans', np.int64  , (nchans,)),
+        ('edges', np.float64, (len(MON_HISTS), nbins + 1)),
+        ('hists', np.int64  , (len(MON_HISTS), nchans, nbins + 2)), # under and overflow bins
+        ('hits' , np.int64  , (nchans,)),
+        ('nev'  , np.int64  , (nchans,)),
+        ('pedmean', np.float64, (nchans,)), # running mean baseline, see lappdMonitor.alpha
+        ('rates', np.float64, (nrate, len(MON_RATES))),
+        ('drift', np.float64, (nrate, nchans)) # pedmean at every rate entry
+    ]
+
+def MonViews(buf, nchans, nbins, nrate) :
+    views = {'header' : np.ndarray((MON_NHDR,), np.int64, buf, 0)}
+    off = MON_NHDR * 8
+    for name, dt, shape in MonLayout(nchans, nbins, nrate) :
+        views[name] = np.ndarray(shape, dt, buf, off)
+        off += views[name].nbytes
+    return views, off
+
+
+class lappdMonitor :
+    # name     : shared memory name, None for a generated one (see self.name)
+    # nbins    : bins per histogram, ranges : {hist : (low, high)}
+    # nbase    : samples at the start of the waveform used for the baseline
+    # polarity : -1 for negative pulses
+    # hit_thr  : amplitude (ADC counts) counted as a hit
+    # interval : s between publications, nrate : entries of the rate history
+    # qsize    : > 0 fill in a separate thread, events are dropped when it lags
+    def __init__(self, chans, name = None, nbins = 200, ranges = None, nbase = 64, polarity = -1,
+                 hit_thr = 50, interval = 0.5, nrate = 600, alpha = 0.05, qsize = 0) :
+        self.chans    = list(chans)
+        self.nbins    = nbins
+        self.ranges   = dict(MON_RANGES, **(ranges or {}))
+        self.nbase    = nbase
+        self.polarity = polarity
+        self.hit_thr  = hit_thr
+        self.interval = interval
+        self.nrate    = nrate
+        self.alpha    = alpha
+        self.rc       = None
+        nch = len(self.chans)
+
+        size = MON_NHDR * 8 + sum(np.dtype(dt).itemsize * int(np.prod(shape))
+                                  for name, dt, shape in MonLayout(nch, nbins, nrate))
+        self.shm = shared_memory.SharedMemory(name, create = True, size = size)
+        self.name = self.shm.name
+        self.views, _ = MonViews(self.shm.buf, nch, nbins, nrate)
+        self.views['header'][:] = 0
+        hdr = self.views['header']
+        hdr[MON_H_MAGIC], hdr[MON_H_VERSION] = MON_MAGIC, MON_VERSION
+        hdr[MON_H_NCHANS], hdr[MON_H_NBINS], hdr[MON_H_NRATE] = nch, nbins, nrate
+        # resource tracker owning the block, see lappdMonView
+        hdr[MON_H_PID], hdr[MON_H_TRACKER] = os.getpid(), resource_tracker._resource_tracker._pid or 0
+
+        # private copies, filled per event and copied to shared memory on Publish()
+        self.edges = np.array([np.linspace(*self.ranges[h], nbins + 1) for h in MON_HISTS])
+        self.lo    = self.edges[:, 0][:, np.newaxis]
+        self.scale = (nbins / (self.edges[:, -1] - self.edges[:, 0]))[:, np.newaxis]
+        self.hists = np.zeros((len(MON_HISTS), nch, nbins + 2), dtype = np.int64)
+        self.hits  = np.zeros(nch, dtype = np.int64)
+        self.nev   = np.zeros(nch, dtype = np.int64)
+        self.pedmean = np.zeros(nch)
+        self.nEvents  = 0
+        self.nDropped = 0
+        self.nUpdates = 0
+        self.ratepos  = 0
+        self.last     = None # (time, triggers, events, ext triggers) of the last rate entry
+        self.tPub     = 0
+        self.views['chans'][:] = self.chans
+        self.views['edges'][:] = self.edges
+
+        self.q = queue.Queue(qsize) if qsize > 0 else None
+        self.thread = None
+        if self.q is not None :
+            self.thread = threading.Thread(target = self._Worker, daemon = True)
+            self.thread.start()
+
+    # lappdRunControl callback, data : (nchans, nsamples) in the order of chans
+    def __call__(self, evt, data) :
+        if self.q is None : return self.Fill(data)
+        try :
+            self.q.put_nowait(data)
+        except queue.Full :
+            self.nDropped += 1
+
+    # lappdRx receiver callback
+    def RxCallback(self, ev) :
+        if hasattr(ev, 'ToDense') : self(ev.evt, ev.ToDense(self.chans))
+        elif list(ev.chans) == self.chans : self(ev.evt, ev.data)
+        else :
+            idx = [list(ev.chans).index(ch) for ch in self.chans if ch in ev.chans]
+            if len(idx) == len(self.chans) : self(ev.evt, ev.data[idx])
+
+    # monitor the events of a lappdRunControl, the existing callback is kept
+    def Attach(self, rc) :
+        self.rc = rc
+        prev = rc.callback
+        if prev is None :
+            rc.callback = self
+        else :
+            def both(evt, data) :
+                prev(evt, data)
+                self(evt, data)
+            rc.callback = both
+
+    def _Worker(self) :
+        while True :
+            data = self.q.get()
+            if data is None : break
+            self.Fill(data)
+        self.Publish()
+
+    def Fill(self, data) :
+        x = np.asarray(data, dtype = np.float32)
+        base = x[:, :self.nbase]
+        ped  = base.mean(axis = 1)
+        rms  = base.std(axis = 1)
+        amp  = (self.polarity * (x - ped[:, np.newaxis])).max(axis = 1)
+
+        vals = np.stack((ped, rms, amp))
+        ibin = np.clip(np.floor((vals - self.lo) * self.scale).astype(np.int64) + 1, 0, self.nbins + 1)
+        nh, nch = vals.shape
+        np.add.at(self.hists, (np.arange(nh)[:, np.newaxis], np.arange(nch), ibin), 1)
+        self.hits += amp > self.hit_thr
+        if self.nEvents == 0 : self.pedmean[:] = ped
+        else                 : self.pedmean += self.alpha * (ped - self.pedmean)
+        self.nev += 1
+        self.nEvents += 1
+        if time.time() - self.tPub >= self.interval : self.Publish()
+
+    # rate entry from the run control counters (no board access)
+    def _Rates(self, t) :
+        rc = self.rc
+        cnt = (t, rc.nTriggers if rc else 0, self.nEvents, rc.nExtTrg if rc else 0)
+        if self.last is None :
+            self.last = cnt
+            return None
+        dt = max(t - self.last[0], 1e-9)
+        r = [t] + [(c - l) / dt for c, l in zip(cnt[1:], self.last[1:])]
+        self.last = cnt
+        return r
+
+    # copy the histograms to shared memory
+    def Publish(self) :
+        t = time.time()
+        self.tPub = t
+        v, hdr = self.views, self.views['header']
+        r = self._Rates(t)
+        hdr[MON_H_SEQ] += 1
+        v['hists'][:]   = self.hists
+        v['hits'][:]    = self.hits
+        v['nev'][:]     = self.nev
+        v['pedmean'][:] = self.pedmean
+        if r is not None :
+            v['rates'][self.ratepos % self.nrate] = r
+            v['drift'][self.ratepos % self.nrate] = self.pedmean
+            self.ratepos += 1
+        self.nUpdates += 1
+        hdr[MON_H_UPDATES] = self.nUpdates
+        hdr[MON_H_EVENTS]  = self.nEvents
+        hdr[MON_H_DROPPED] = self.nDropped
+        hdr[MON_H_RATEPOS] = self.ratepos
+        hdr[MON_H_SEQ] += 1
+
+    def Reset(self) :
+        self.hists[:] = 0
+        self.hits[:]  = 0
+        self.nev[:]   = 0
+        self.Publish()
+
+    def Close(self) :
+        if self.thread is not None :
+            self.q.put(None)
+            self.thread.join()
+            self.thread = None
+        else :
+            self.Publish()
+        self.views = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+# True if this process uses the resource tracker of the monitor hdr :
+# the monitor process itself, a child forked after the tracker was
+# started or a spawned child (tracker inherited from the parent)
+def MonSharedTracker(hdr) :
+    rt = resource_tracker._resource_tracker
+    if os.getpid() == hdr[MON_H_PID] : return True
+    if rt._pid is not None : return rt._pid == hdr[MON_H_TRACKER]
+    return rt._fd is not None and os.getppid() == hdr[MON_H_PID]
+
+
+# read only access to the histograms of a lappdMonitor
+class lappdMonView :
+    def __init__(self, name) :
+        try :
+            self.shm = shared_memory.SharedMemory(name, track = False)
+        except TypeError :
+            # before python 3.13 attaching registers the block with the resource
+            # tracker, which unlinks it when this process ends : the registration
+            # is undone unless the tracker is the monitor's one, where it is the
+            # monitor's own registration (needed by lappdMonitor.Close)
+            self.shm = shared_memory.SharedMemory(name)
+            hdr = np.ndarray((MON_NHDR,), np.int64, self.shm.buf, 0)
+            if not MonSharedTracker(hdr) : resource_tracker.unregister(self.shm._name, 'shared_memory')
+        hdr = np.ndarray((MON_NHDR,), np.int64, self.shm.buf, 0)
+        if hdr[MON_H_MAGIC] != MON_MAGIC or hdr[MON_H_VERSION] != MON_VERSION :
+            raise Exception('%s is not a monitoring block' % (name))
+        self.views, _ = MonViews(self.shm.buf, int(hdr[MON_H_NCHANS]), int(hdr[MON_H_NBINS]), int(hdr[MON_H_NRATE]))
+
+    # consistent copy of all arrays, rate history in time order
+    def Snapshot(self, timeout = 1.0) :
+        hdr = self.views['header']
+        t0 = time.time()
+        while True :
+            s1 = int(hdr[MON_H_SEQ])
+            if s1 % 2 == 0 :
+                snap = {name : v.copy() for name, v in self.views.items()}
+                if int(hdr[MON_H_SEQ]) == s1 : break
+            if time.time() - t0 > timeout : raise TimeoutError('monitoring block is not updated consistently')
+            time.sleep(0.0001)
+        h = snap.pop('header')
+        n, pos = len(snap['rates']), int(h[MON_H_RATEPOS])
+        order = np.arange(max(pos - n, 0), pos) % n
+        snap['rates'] = snap['rates'][order]
+        snap['drift'] = snap['drift'][order]
+        snap['updates'] = int(h[MON_H_UPDATES])
+        snap['events']  = int(h[MON_H_EVENTS])
+        snap['dropped'] = int(h[MON_H_DROPPED])
+        snap['hists']   = {name : snap['hists'][i] for i, name in enumerate(MON_HISTS)}
+        snap['edges']   = {name : snap['edges'][i] for i, name in enumerate(MON_HISTS)}
+        return snap
+
+    def PrintSummary(self, f = sys.stderr) :
+        s = self.Snapshot()
+        print('%d events, %d dropped, %d updates' % (s['events'], s['dropped'], s['updates']), file=f)
+        if len(s['rates']) > 0 :
+            r = s['rates'][-1]
+            print('rates [Hz] : ' + ' '.join('%s %.1f' % (c, v) for c, v in zip(MON_RATES[1:], r[1:])), file=f)
+        print('%4s %8s %8s %8s %10s' % ('chan', 'ped', 'rms', 'amp', 'hit rate'), file=f)
+        for i, ch in enumerate(s['chans']) :
+            m = []
+            for name in MON_HISTS :
+                h, e = s['hists'][name][i, 1:-1], s['edges'][name]
+                m.append(np.sum(h * (e[:-1] + e[1:]) / 2) / max(h.sum(), 1))
+            print('%4d %8.1f %8.2f %8.1f %10.3f' % (ch, m[0], m[1], m[2], s['hits'][i] / max(s['nev'][i], 1)), file=f)
+
+    def Close(self) :
+        self.views = None
+        self.shm.close()
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+
+import os
+import numpy as np
+
+FLAG_LIMIT = 9999 # |sample| of ADC underflow/overflow flags, see lappdIfc.DecodeAdcWords
+
+#####################################################
+# Streaming per cell pedestal mean and RMS
+# Welford / Chan update on whole (nchans, ncells) arrays,
+# any number of events, flagged samples are ignored
+#####################################################
+class lappdPedestals :
+    def __init__(self, chans, ncells = 1024) :
+        self.chans  = list(chans)
+        self.ncells = ncells
+        self.Reset()
+
+    def Reset(self) :
+        shape = (len(self.chans), self.ncells)
+        self.n    = np.zeros(shape, dtype = np.int64)
+        self.mean = np.zeros(shape, dtype = np.float64)
+        self.m2   = np.zeros(shape, dtype = np.float64)
+        self.nev  = 0
+
+    # add events, data : (nchans, ncells) or (nev, nchans, ncells)
+    # reject > 0 : ignore samples further than reject*rms from the current
+    #              mean, once a cell has at least min_rej entries
+    def Add(self, data, reject = 0, min_rej = 10) :
+        x = np.asarray(data, dtype = np.float64)
+        if x.ndim == 2 : x = x[np.newaxis]
+        w = np.abs(x) < FLAG_LIMIT
+        if reject > 0 :
+            rms = self.Rms()
+            w &= (self.n < min_rej) | (np.abs(x - self.mean) <= reject * rms)
+
+        nb    = w.sum(axis = 0)
+        sumb  = np.where(w, x, 0).sum(axis = 0)
+        meanb = sumb / np.maximum(nb, 1)
+        m2b   = np.where(w, x - meanb, 0)
+        m2b   = (m2b * m2b).sum(axis = 0)
+
+        ntot  = self.n + nb
+        delta = meanb - self.mean
+        frac  = np.divide(nb, ntot, out = np.zeros(ntot.shape), where = ntot > 0)
+        self.mean += delta * frac
+        self.m2   += m2b + delta * delta * self.n * frac
+        self.n     = ntot
+        self.nev  += x.shape[0]
+
+    def Mean(self) :
+        return self.mean.copy()
+
+    def Rms(self) :
+        return np.sqrt(np.divide(self.m2, self.n, out = np.zeros(self.m2.shape), where = self.n > 0))
+
+    # row index of channel ch
+    def Index(self, ch) :
+        return self.chans.index(ch)
+
+    # written to fname as given (np.savez would append .npz to a name without it)
+    def Save(self, fname) :
+        with open(fname, 'wb') as f :
+            np.savez(f, chans = self.chans, n = self.n, mean = self.mean, m2 = self.m2, nev = self.nev)
+
+    @staticmethod
+    def Load(fname) :
+        # files written by np.savez under a name without .npz
+        if not os.path.exists(fname) and os.path.exists(fname + '.npz') : fname += '.npz'
+        f = np.load(fname)
+        p = lappdPedestals(f['chans'].tolist(), f['mean'].shape[1])
+        p.n    = f['n']
+        p.mean = f['mean']
+        p.m2   = f['m2']
+        p.nev  = int(f['nev'])
+        return p
@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+
+import sys
+import json
+import time
+import threading
+import contextlib
+import numpy as np
+
+from lappdIfc import ADDR_DAC_OFFSET, ADDR_ADCSPI_OFFSET, ADDR_ADCBUF_OFFSET, \
+                     ADDR_DRSCFG_OFFSET, ADDR_PEDMEM_OFFSET
+
+# address blocks, the block of an address is addr >> 18
+PROF_BLOCKS = {
+    0                        : 'REG',
+    ADDR_DAC_OFFSET    >> 18 : 'DAC',
+    ADDR_ADCSPI_OFFSET >> 18 : 'ADCSPI',
+    ADDR_ADCBUF_OFFSET >> 18 : 'ADCBUF',
+    ADDR_DRSCFG_OFFSET >> 18 : 'DRSCFG',
+    ADDR_PEDMEM_OFFSET >> 18 : 'PEDMEM'
+}
+PROF_BINS = np.logspace(-6, 1, 71) # 1 us .. 10 s, 10 bins per decade
+
+def BlockName(addr) :
+    return PROF_BLOCKS.get(addr >> 18, 'BLK%d' % (addr >> 18))
+
+#####################################################
+# Register traffic profiler
+#
+#   prof = lappdProfiler()
+#   prof.Attach(ifc)
+#   ... ifc.Initialize() ...
+#   prof.PrintSummary()
+#
+# counts transactions per register and address block,
+# keeps transfer latency histograms per block and splits
+# the wall time of high level operations (Profiled
+# methods of lappdInterface) into network and host time
+#####################################################
+class lappdProfiler :
+    def __init__(self, trace = False, maxtrace = 1000000) :
+        self.lock     = threading.Lock()
+        self.local    = threading.local()
+        self.trace    = trace
+        self.maxtrace = maxtrace
+        self.Reset()
+
+    def Reset(self) :
+        self.t0      = time.perf_counter()
+        self.regs    = {} # addr -> transactions (main register space only)
+        self.blocks  = {} # name -> [transactions, transfers, time, histogram]
+        self.ops     = {} # name -> [calls, wall, network, transactions]
+        self.events  = []
+
+    def Attach(self, ifc) :
+        ifc.prof = self
+
+    def Detach(self, ifc) :
+        ifc.prof = None
+
+    def _Stack(self) :
+        if not hasattr(self.local, 'stack') : self.local.stack = []
+        return self.local.stack
+
+    # one transfer of the addresses in addrs, started at t0 (perf_counter)
+    def Record(self, addrs, t0) :
+        t1 = time.perf_counter()
+        dt = t1 - t0
+        with self.lock :
+            bcount = {}
+            for a in addrs :
+                b = BlockName(a)
+                bcount[b] = bcount.get(b, 0) + 1
+                if b == 'REG' : self.regs[a] = self.regs.get(a, 0) + 1
+            # latency is booked to the block with most transactions
+            bmain = max(bcount, key = bcount.get)
+            for b, n in bcount.items() :
+                ent = self.blocks.get(b)
+                if ent is None :
+                    ent = [0, 0, 0.0, np.zeros(len(PROF_BINS) + 1, dtype = np.int64)]
+                    self.blocks[b] = ent
+                ent[0] += n
+                if b == bmain :
+                    ent[1] += 1
+                    ent[2] += dt
+                    ent[3][np.searchsorted(PROF_BINS, dt)] += 1
+            for name in self._Stack() :
+                op = self.ops[name]
+                op[2] += dt
+                op[3] += len(addrs)
+            if self.trace and len(self.events) < self.maxtrace :
+                self.events.append(('%s x%d' % (bmain, len(addrs)), t0, dt, threading.get_ident(), 'transfer'))
+
+    # attribute everything inside to operation name
+    @contextlib.contextmanager
+    def Op(self, name) :
+        with self.lock :
+            if name not in self.ops : self.ops[name] = [0, 0.0, 0.0, 0]
+        stack = self._Stack()
+        # recursive calls are counted once
+        nested = name in stack
+        if not nested : stack.append(name)
+        t0 = time.perf_counter()
+        try :
+            yield
+        finally :
+            dt = time.perf_counter() - t0
+            if not nested :
+                stack.pop()
+                with self.lock :
+                    op = self.ops[name]
+                    op[0] += 1
+                    op[1] += dt
+                    if self.trace and len(self.events) < self.maxtrace :
+                        self.events.append((name, t0, dt, threading.get_ident(), 'op'))
+
+    # latency quantile (s) from the histogram
+    @staticmethod
+    def Quantile(hist, q) :
+        c = np.cumsum(hist)
+        if c[-1] == 0 : return 0.0
+        i = int(np.searchsorted(c, q * c[-1]))
+        edges = np.concatenate(([0], PROF_BINS, [PROF_BINS[-1]]))
+        return float(edges[i + 1])
+
+    def Summary(self) :
+        wall = time.perf_counter() - self.t0
+        with self.lock :
+            blocks = {}
+            for b, (ntr, nxfer, t, hist) in self.blocks.items() :
+                blocks[b] = {
+                    'transactions' : ntr,
+                    'transfers'    : nxfer,
+                    'time'         : t,
+                    'mean'         : t / max(nxfer, 1),
+                    'p50'          : self.Quantile(hist, 0.5),
+                    'p99'          : self.Quantile(hist, 0.99),
+                    'hist'         : hist.tolist()
+                }
+            ops = {}
+            for name, (ncalls, t, tnet, ntr) in self.ops.items() :
+                ops[name] = {
+                    'calls'        : ncalls,
+                    'wall'         : t,
+                    'network'      : tnet,
+                    'host'         : max(t - tnet, 0),
+                    'transactions' : ntr
+                }
+            regs = {hex(a) : n for a, n in sorted(self.regs.items(), key = lambda x : -x[1])}
+        return {'wall' : wall, 'bins' : PROF_BINS.tolist(), 'blocks' : blocks, 'ops' : ops, 'regs' : regs}
+
+    def PrintSummary(self, f = sys.stderr, nregs = 10) :
+        s = self.Summary()
+        print('%-8s %12s %10s %10s %10s %10s' % ('block', 'transactions', 'transfers', 'time [s]', 'p50 [ms]', 'p99 [ms]'), file=f)
+        for b, st in s['blocks'].items() :
+            print('%-8s %12d %10d %10.3f %10.3f %10.3f' % (b, st['transactions'], st['transfers'], st['time'],
+                  1e3*st['p50'], 1e3*st['p99']), file=f)
+        print('%-26s %6s %10s %10s %10s %12s' % ('operation', 'calls', 'wall [s]', 'net [s]', 'host [s]', 'transactions'), file=f)
+        for name, st in s['ops'].items() :
+            print('%-26s %6d %10.3f %10.3f %10.3f %12d' % (name, st['calls'], st['wall'], st['network'],
+                  st['host'], st['transactions']), file=f)
+        print('most accessed registers :', file=f)
+        for a, n in list(s['regs'].items())[:nregs] :
+            print('  %8s %10d' % (a, n), file=f)
+
+    def SaveSummary(self, fname) :
+        with open(fname, 'w') as f : json.dump(self.Summary(), f, indent = 1)
+
+    # chrome://tracing / perfetto json
+    def SaveTrace(self, fname) :
+        with self.lock :
+            evs = [{'name' : name, 'cat' : cat, 'ph' : 'X', 'pid' : 0, 'tid' : tid,
+                    'ts' : 1e6*(t0 - self.t0), 'dur' : 1e6*dt}
+                   for name, t0, dt, tid, cat in self.events]
+        with open(fname, 'w') as f : json.dump({'traceEvents' : evs}, f)
@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+
+import json
+
+#####################################################
+# Declarative register map and configuration profiles
+#
+# a register has a name, an address, an access type,
+# optional bit fields and the firmware versions it
+# exists in. A profile is an ordered dict
+#   {register name : value or {field name : value}}
+# e.g. {'ADCBUFNUMWORDS' : 1024, 'MODE' : {'EXTTRG_EN' : 1}}
+# fields not named in a profile keep their current value
+#####################################################
+REG_RW     = 'rw'     # read / write
+REG_RO     = 'ro'     # read only, status and counters
+REG_WO     = 'wo'     # write only, read back is not meaningful
+REG_STROBE = 'strobe' # bits are pulses, an action rather than a state
+
+class lappdReg :
+    # fields : {name : (lsb, width)}
+    # minfw, maxfw : firmware versions having the register (maxfw = -1 : no limit)
+    def __init__(self, name, addr, access = REG_RW, fields = None, minfw = 0, maxfw = -1, default = 0, doc = '') :
+        self.name    = name
+        self.addr    = addr
+        self.access  = access
+        self.fields  = dict(fields) if fields is not None else {}
+        self.minfw   = minfw
+        self.maxfw   = maxfw
+        self.default = default
+        self.doc     = doc
+
+    def __repr__(self) :
+        return 'lappdReg(%s, 0x%x, %s)' % (self.name, self.addr, self.access)
+
+    def Supported(self, fwver) :
+        return fwver >= self.minfw and (self.maxfw < 0 or fwver <= self.maxfw)
+
+    def Field(self, name) :
+        if name not in self.fields :
+            raise Exception('register %s has no field %s' % (self.name, name))
+        return self.fields[name]
+
+    # mask and value of the fields in values {field : value}
+    def Encode(self, values) :
+        mask, val = 0, 0
+        for name, v in values.items() :
+            lsb, width = self.Field(name)
+            m = ((1 << width) - 1) << lsb
+            if int(v) >> width :
+                raise Exception('value %d does not fit in %s.%s' % (v, self.name, name))
+            mask |= m
+            val  |= int(v) << lsb
+        return mask, val
+
+    # {field : value} of a register value
+    def Decode(self, value) :
+        return {name : (value >> lsb) & ((1 << width) - 1) for name, (lsb, width) in self.fields.items()}
+
+
+class lappdRegMap :
+    def __init__(self, regs = ()) :
+        self.regs   = {}
+        self.byaddr = {}
+        for r in regs : self.Add(r)
+
+    def Add(self, reg) :
+        if reg.name in self.regs : raise Exception('register %s defined twice' % (reg.name))
+        self.regs[reg.name]   = reg
+        self.byaddr[reg.addr] = reg
+        return reg
+
+    # n registers NAME_0 .. NAME_n-1, stride bytes apart
+    def Array(self, name, addr, n, stride = 4, **kwargs) :
+        return [self.Add(lappdReg('%s_%d' % (name, i), addr + i*stride, **kwargs)) for i in range(n)]
+
+    def __getitem__(self, name) :
+        if name not in self.regs : raise Exception('unknown register %s' % (name))
+        return self.regs[name]
+
+    def __contains__(self, name) :
+        return name in self.regs
+
+    def __iter__(self) :
+        return iter(self.regs.values())
+
+    def __len__(self) :
+        return len(self.regs)
+
+    def ByAddr(self, addr) :
+        return self.byaddr.get(addr)
+
+    # registers a profile can set for firmware fwver
+    def Writable(self, fwver) :
+        return [r for r in self if r.access in (REG_RW, REG_WO) and r.Supported(fwver)]
+
+    # profile -> list of (reg, mask, value) in profile order and names of the
+    # registers skipped because firmware fwver does not have them
+    def Resolve(self, profile, fwver) :
+        ents, skipped = [], []
+        for name, v in profile.items() :
+            reg = self[name]
+            if reg.access not in (REG_RW, REG_WO) :
+                raise Exception('register %s is not writable (%s)' % (name, reg.access))
+            if not reg.Supported(fwver) :
+                skipped.append(name)
+                continue
+            if isinstance(v, dict) : mask, val = reg.Encode(v)
+            else                   : mask, val = 0xffffffff, int(v) & 0xffffffff
+            ents.append((reg, mask, val))
+        return ents, skipped
+
+
+def LoadProfile(fname) :
+    with open(fname) as f : return json.load(f)
+
+def SaveProfile(profile, fname) :
+    with open(fname, 'w') as f : json.dump(profile, f, indent = 1)
@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import argparse
+import concurrent.futures
+import numpy as np
+
+from lappdPeds import FLAG_LIMIT, lappdPedestals
+from lappdTime import lappdTimeCalib
+from lappdRunFile import lappdRunReader
+
+#####################################################
+# Offline reprocessing of run files
+#
+#   rp = lappdReprocess('run.lappd', 'run_ana', peds = 'file', timecal = 'tcal.npz')
+#   rp.Run()
+#   res, meta = LoadResults('run_ana') # {column : np.memmap}
+#
+# the run is split in chunks of events processed by a
+# pool of processes, every worker maps the run file and
+# writes its rows of the output columns (one .npy file per
+# column in the output directory) directly, so only chunk
+# boundaries travel between processes
+#####################################################
+
+# per event columns
+REPROC_EVENT_COLS = [('run', '<u4'), ('evt', '<u4'), ('time', '<f8')]
+# per event and channel columns, shape (nev, nchans)
+REPROC_CHAN_COLS  = [
+    ('baseline', '<f4'), # mean of the first nbase samples
+    ('rms'     , '<f4'), # RMS of the first nbase samples
+    ('amp'     , '<f4'), # peak amplitude above baseline (times polarity)
+    ('peak'    , '<i2'), # sample of the peak
+    ('charge'  , '<f4'), # sum around the peak, ADC counts x sample width
+    ('tcfd'    , '<f4'), # constant fraction time, nan if not found
+    ('flags'   , 'u1')   # REPROC_FLAG_* bits
+]
+REPROC_FLAG_ADC   = 1 # ADC underflow/overflow sample in the waveform
+REPROC_FLAG_NOCFD = 2 # no constant fraction crossing before the peak
+
+# features of waveforms x (..., nsamples), pedestal subtracted
+# t : sample times of the same shape (timing calibration), sample index if None
+# charge window : [peak - pre, peak + post], cfd at frac of the amplitude
+# bad : ADC flag mask of x, from the samples before pedestal subtraction
+#       (flags are no longer exactly at FLAG_LIMIT afterwards), from x if None
+def PulseFeatures(x, t = None, nbase = 64, polarity = -1, frac = 0.5, pre = 10, post = 30, bad = None) :
+    x = np.array(x, dtype = np.float32)
+    ns = x.shape[-1]
+    if bad is None : bad = np.abs(x) >= FLAG_LIMIT
+    flags = np.where(bad.any(axis = -1), REPROC_FLAG_ADC, 0).astype(np.uint8)
+
+    base = x[..., :nbase]
+    if bad.any() :
+        x[bad] = 0
+        base = np.where(bad[..., :nbase], np.nan, base)
+    baseline = np.nanmean(base, axis = -1) if bad.any() else base.mean(axis = -1)
+    rms      = np.nanstd(base, axis = -1)  if bad.any() else base.std(axis = -1)
+
+    y = polarity * (x - baseline[..., np.newaxis])
+    peak = y.argmax(axis = -1)
+    amp  = np.take_along_axis(y, peak[..., np.newaxis], axis = -1)[..., 0]
+
+    # charge from the cumulative sum, weighted by the cell widths if timed
+    if t is not None :
+        dt = np.diff(t, axis = -1)
+        dt = np.concatenate((dt, dt[..., -1:]), axis = -1)
+        yq = y * dt
+    else :
+        yq = y
+    cs = np.concatenate((np.zeros(y.shape[:-1] + (1,), np.float64), np.cumsum(yq, axis = -1, dtype = np.float64)), axis = -1)
+    lo = np.clip(peak - pre, 0, ns - 1)
+    hi = np.clip(peak + post, 0, ns - 1)
+    charge = np.take_along_axis(cs, (hi + 1)[..., np.newaxis], axis = -1)[..., 0] - \
+             np.take_along_axis(cs, lo[..., np.newaxis], axis = -1)[..., 0]
+
+    # constant fraction : last sample below frac*amp before the peak
+    thr = frac * amp
+    idx = np.arange(ns)
+    cand = (y < thr[..., np.newaxis]) & (idx < peak[..., np.newaxis])
+    i = np.where(cand, idx, -1).max(axis = -1)
+    ok = i >= 0
+    i0 = np.maximum(i, 0)[..., np.newaxis]
+    y0 = np.take_along_axis(y, i0, axis = -1)[..., 0]
+    y1 = np.take_along_axis(y, i0 + 1, axis = -1)[..., 0]
+    f = (thr - y0) / np.where(y1 != y0, y1 - y0, 1)
+    if t is not None :
+        t0 = np.take_along_axis(t, i0, axis = -1)[..., 0]
+        t1 = np.take_along_axis(t, i0 + 1, axis = -1)[..., 0]
+        tcfd = t0 + f * (t1 - t0)
+    else :
+        tcfd = i0[..., 0] + f
+    tcfd = np.where(ok, tcfd, np.nan)
+    flags |= np.where(ok, 0, REPROC_FLAG_NOCFD).astype(np.uint8)
+
+    return {'baseline' : baseline, 'rms' : rms, 'amp' : amp, 'peak' : peak, 'charge' : charge,
+            'tcfd' : tcfd, 'flags' : flags}
+
+# pedestal rows (nchans, nsamples) for the channels of a run
+# peds : None, 'file' (pedestals stored in the run), array or lappdPedestals .npz
+def PedRows(rd, peds) :
+    if peds is None : return None
+    if isinstance(peds, str) and peds == 'file' :
+        p = rd.peds
+        if p.shape[0] == 0 : raise Exception('run file has no pedestals')
+        return np.broadcast_to(p, (len(rd.chans), rd.nsamples)).astype(np.float32)
+    if isinstance(peds, str) :
+        tab = lappdPedestals.Load(peds)
+        mean = tab.Mean()
+        return np.stack([np.resize(mean[tab.Index(ch)], rd.nsamples) for ch in rd.chans]).astype(np.float32)
+    return np.broadcast_to(np.asarray(peds, dtype = np.float32), (len(rd.chans), rd.nsamples))
+
+# one chunk in a worker : events [i0, i1) of fname into the columns in outdir
+def ReprocessChunk(fname, outdir, i0, i1, peds, timecal, params) :
+    rd = lappdRunReader(fname)
+    ev = rd.events[i0 : i1]
+    x = ev['data'].astype(np.float32)
+    bad = np.abs(ev['data']) >= FLAG_LIMIT
+    if peds is not None : x -= peds
+    t = None
+    if timecal is not None :
+        tcal = lappdTimeCalib.Load(timecal)
+        rows = [tcal.Index(ch) for ch in rd.chans]
+        t = tcal.Times(ev['stops'], rd.nsamples, rows)
+    res = PulseFeatures(x, t, bad = bad, **params)
+    for name, dt in REPROC_EVENT_COLS :
+        col = np.load(os.path.join(outdir, name + '.npy'), mmap_mode = 'r+')
+        col[i0 : i1] = ev[name]
+        col.flush()
+    for name, dt in REPROC_CHAN_COLS :
+        col = np.load(os.path.join(outdir, name + '.npy'), mmap_mode = 'r+')
+        col[i0 : i1] = res[name]
+        col.flush()
+    return i1 - i0
+
+
+class lappdReprocess :
+    # peds     : see PedRows, None if the run holds pedestal subtracted data
+    # timecal  : lappdTimeCalib .npz file, the run must have stop cells
+    # nworkers : processes, all cores by default, 1 to run in this process
+    # params   : PulseFeatures parameters
+    def __init__(self, fname, outdir, peds = None, timecal = None, nchunk = 1000, nworkers = 0, **params) :
+        self.fname    = fname
+        self.outdir   = outdir
+        self.timecal  = timecal
+        self.nchunk   = nchunk
+        self.nworkers = nworkers if nworkers > 0 else os.cpu_count()
+        self.params   = params
+        self.rd       = lappdRunReader(fname)
+        self.peds     = PedRows(self.rd, peds)
+        if timecal is not None and not self.rd.stops :
+            raise Exception('%s has no stop cells, timing calibration can not be applied' % (fname))
+
+    # output columns, preallocated so workers can write their rows
+    def Create(self) :
+        os.makedirs(self.outdir, exist_ok = True)
+        nev, nch = len(self.rd), len(self.rd.chans)
+        for name, dt in REPROC_EVENT_COLS :
+            np.lib.format.open_memmap(os.path.join(self.outdir, name + '.npy'), 'w+', dt, (nev,))
+        for name, dt in REPROC_CHAN_COLS :
+            np.lib.format.open_memmap(os.path.join(self.outdir, name + '.npy'), 'w+', dt, (nev, nch))
+        meta = {
+            'run_file' : os.path.abspath(self.fname),
+            'chans'    : self.rd.chans,
+            'nevents'  : nev,
+            'timecal'  : self.timecal,
+            'params'   : self.params,
+            'created'  : time.time()
+        }
+        with open(os.path.join(self.outdir, 'meta.json'), 'w') as f : json.dump(meta, f, indent = 1)
+
+    def Run(self, f = sys.stderr) :
+        t0 = time.time()
+        self.Create()
+        nev = len(self.rd)
+        chunks = [(i0, min(i0 + self.nchunk, nev)) for i0 in range(0, nev, self.nchunk)]
+        args = (self.peds, self.timecal, self.params)
+        ndone = 0
+        if self.nworkers == 1 :
+            for i0, i1 in chunks : ndone += ReprocessChunk(self.fname, self.outdir, i0, i1, *args)
+        else :
+            with concurrent.futures.ProcessPoolExecutor(self.nworkers) as ex :
+                futs = [ex.submit(ReprocessChunk, self.fname, self.outdir, i0, i1, *args) for i0, i1 in chunks]
+                for fut in concurrent.futures.as_completed(futs) :
+                    ndone += fut.result()
+        wall = time.time() - t0
+        if f is not None :
+            print('%d events in %.1f s (%.0f Hz) with %d workers' % (ndone, wall, ndone / max(wall, 1e-9),
+                  self.nworkers), file=f)
+        return ndone
+
+
+# columns of a reprocessed run as read only memory maps, and its meta data
+def LoadResults(outdir) :
+    with open(os.path.join(outdir, 'meta.json')) as f : meta = json.load(f)
+    res = {name : np.load(os.path.join(outdir, name + '.npy'), mmap_mode = 'r')
+           for name, dt in REPROC_EVENT_COLS + REPROC_CHAN_COLS}
+    return res, meta
+
+if __name__ == '__main__' :
+    ap = argparse.ArgumentParser(description = 'reprocess LAPPD run files')
+    ap.add_argument('runs', nargs = '+')
+    ap.add_argument('-o', '--outdir', default = '', help = 'output directory, <run>_ana by default')
+    ap.add_argument('-p', '--peds', default = None, help = "'file' or a lappdPedestals .npz")
+    ap.add_argument('-t', '--timecal', default = None, help = 'lappdTimeCalib .npz')
+    ap.add_argument('-j', '--nworkers', type = int, default = 0)
+    ap.add_argument('-c', '--nchunk', type = int, default = 1000)
+    args = ap.parse_args()
+    for fname in args.runs :
+        outdir = os.path.splitext(fname)[0] + '_ana'
+        if args.outdir : outdir = args.outdir if len(args.runs) == 1 else os.path.join(args.outdir, os.path.basename(outdir))
+        lappdReprocess(fname, outdir, args.peds, args.timecal, args.nchunk, args.nworkers).Run()
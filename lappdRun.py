@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+
+import sys
+import time
+import queue
+import threading
+
+from lappdIfc import *
+
+#####################################################
+# Triggered acquisition
+#
+#   readout thread : arm trigger, wait for the ADC buffer,
+#                    bulk read of raw words
+#   decode thread  : decoding and pedestal subtraction
+#   store thread   : run file writer and/or callback
+# stages are connected by bounded queues, a full queue
+# stalls the previous stage (counted as dead time)
+#####################################################
+class lappdRunControl :
+    # chans    : channels to read, enabled channels by default
+    # writer   : lappdRunFile.lappdRunWriter or None
+    # callback : callback(evt, data) for every decoded event
+    # exttrg   : use external trigger instead of software triggers
+    # stops    : read the DRS4 stop cells of every event (for timing calibration)
+    def __init__(self, ifc, chans = None, writer = None, callback = None, exttrg = False,
+                 qsize = 64, timeout = 1.0, stops = False) :
+        self.ifc      = ifc
+        self.chans    = list(chans) if chans is not None else ifc.GetChanMask()
+        self.writer   = writer
+        self.callback = callback
+        self.exttrg   = exttrg
+        self.stops    = stops
+        self.timeout  = timeout # s, waiting for a trigger / for the buffer
+        self.rawq     = queue.Queue(qsize)
+        self.decq     = queue.Queue(qsize)
+        self.running  = False
+        self.threads  = []
+        self.error    = None # first exception of a stage, raised by Wait()
+        self.ResetStats()
+
+    def ResetStats(self) :
+        self.nTriggers  = 0
+        self.nRead      = 0
+        self.nDecoded   = 0
+        self.nStored    = 0
+        self.nTimeouts  = 0
+        self.nExtTrg    = 0 # external triggers counted by the board
+        self.tDead      = 0 # s, trigger to readout done
+        self.tStall     = 0 # s, readout waiting for the decode stage
+        self.tStart     = 0
+        self.tStop      = 0
+
+    def Start(self, nev = -1, run = 0) :
+        self.ResetStats()
+        self.nev     = nev
+        self.run     = run
+        self.running = True
+        self.error   = None
+        if self.exttrg :
+            self.extcnt = self.ifc.RegRead(EXTTRGCNT)
+            self.ifc.RegSetBit(MODE, C_MODE_EXTTRG_EN_BIT, 1)
+        self.tStart  = time.time()
+        self.threads = [threading.Thread(target = self._Readout, daemon = True),
+                        threading.Thread(target = self._Decode , daemon = True),
+                        threading.Thread(target = self._Store  , daemon = True)]
+        for t in self.threads : t.start()
+
+    def Stop(self) :
+        self.running = False
+
+    # wait for the end of the run (nev events, Stop() or an error in a stage,
+    # which is raised here)
+    def Wait(self) :
+        for t in self.threads : t.join()
+        self.threads = []
+        self.tStop = time.time()
+        if self.exttrg : self.ifc.RegSetBit(MODE, C_MODE_EXTTRG_EN_BIT, 0)
+        if self.error is not None : raise self.error
+
+    def Run(self, nev, run = 0) :
+        self.Start(nev, run)
+        self.Wait()
+        return self.Stats()
+
+    # external trigger : wait for EXTTRGCNT to change
+    def WaitTrigger(self) :
+        t0 = time.time()
+        dt = 0.0001
+        while self.running :
+            cnt = self.ifc.RegRead(EXTTRGCNT)
+            if cnt != self.extcnt :
+                self.nExtTrg += (cnt - self.extcnt) & 0xffffffff
+                self.extcnt = cnt
+                return True
+            if time.time() - t0 > self.timeout : return False
+            time.sleep(dt)
+            dt = min(2*dt, 0.001)
+        return False
+
+    # keep the first exception and stop the run, the stages after the failing
+    # one still drain their queues so every thread ends
+    def _Fail(self, e) :
+        if self.error is None : self.error = e
+        self.running = False
+
+    def _Readout(self) :
+        try :
+            while self.running and (self.nev < 0 or self.nRead < self.nev) :
+                self.ifc.AdcBufStart()
+                if self.exttrg :
+                    if not self.WaitTrigger() : continue
+                    t0 = time.time()
+                else :
+                    t0 = time.time()
+                    self.ifc.SoftTrigger()
+                self.nTriggers += 1
+                if self.ifc.WaitBufReady(self.timeout, throw = False) < 0 :
+                    self.nTimeouts += 1
+                    continue
+                stops = self.ifc.StopCells(self.chans) if self.stops else None
+                raw, nsamples = self.ifc.ReadWfsRaw(self.chans)
+                tev = time.time()
+                self.tDead += tev - t0
+                ts = time.time()
+                self.rawq.put((self.nRead, tev, raw, nsamples, stops))
+                self.tStall += time.time() - ts
+                self.nRead += 1
+        except Exception as e :
+            self._Fail(e)
+        finally :
+            self.running = False
+            self.rawq.put(None)
+
+    def _Decode(self) :
+        while True :
+            item = self.rawq.get()
+            if item is None : break
+            if self.error is not None : continue
+            try :
+                evt, tev, raw, nsamples, stops = item
+                data = self.ifc.DecodeWfs(raw, self.chans, nsamples)
+                self.decq.put((evt, tev, data, stops))
+                self.nDecoded += 1
+            except Exception as e :
+                self._Fail(e)
+        self.decq.put(None)
+
+    def _Store(self) :
+        while True :
+            item = self.decq.get()
+            if item is None : break
+            if self.error is not None : continue
+            try :
+                evt, tev, data, stops = item
+                if self.writer is not None : self.writer.Write(evt, data, self.run, tev, stops = stops)
+                if self.callback is not None : self.callback(evt, data)
+                self.nStored += 1
+            except Exception as e :
+                self._Fail(e)
+
+    def Stats(self) :
+        tend = self.tStop if self.tStop > 0 else time.time()
+        wall = max(tend - self.tStart, 1e-9)
+        st = {
+            'triggers'  : self.nTriggers,
+            'read'      : self.nRead,
+            'decoded'   : self.nDecoded,
+            'stored'    : self.nStored,
+            'timeouts'  : self.nTimeouts,
+            'wall'      : wall,
+            'rate'      : self.nStored / wall,
+            'deadtime'  : self.tDead / wall, # fraction of time not sensitive to triggers
+            'stall'     : self.tStall / wall,
+            'rawq'      : self.rawq.qsize(),
+            'decq'      : self.decq.qsize()
+        }
+        if self.exttrg :
+            st['ext_triggers'] = self.nExtTrg
+            st['lost_triggers'] = max(self.nExtTrg - self.nRead, 0)
+        return st
+
+    def PrintStats(self, f = sys.stderr) :
+        st = self.Stats()
+        print('%d events in %.1f s : %.1f Hz, dead time %.1f%%, stalled %.1f%%, %d timeouts'
+              % (st['stored'], st['wall'], st['rate'], 100*st['deadtime'], 100*st['stall'], st['timeouts']), file=f)
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+import sys
+import json
+import queue
+import struct
+import threading
+import time
+import numpy as np
+
+#####################################################
+# Binary run file
+#
+#   header : magic, version, length of json meta
+#            json meta (register snapshot, channels, shapes)
+#            pedestals float32 (nped_rows, nsamples)
+#            padded to RUN_ALIGN bytes
+#   events : fixed size records (see EventDtype), with the
+#            DRS4 stop cell of every channel if meta 'stops' is set
+#   index  : u64 offset of every event record
+#   footer : u64 number of events, u64 index offset, index magic
+# all numbers are little endian
+#####################################################
+RUN_MAGIC     = b'LAPPDRUN'
+RUN_IDX_MAGIC = b'LAPPDIDX'
+RUN_VERSION   = 1
+RUN_ALIGN     = 64
+RUN_HDR       = struct.Struct('<8sII')
+RUN_FOOTER    = struct.Struct('<QQ8s')
+
+def EventDtype(nchans, nsamples, stops = False) :
+    fields = [
+        ('run' , '<u4'),
+        ('evt' , '<u4'),
+        ('time', '<f8'),
+        ('data', '<i2', (nchans, nsamples))
+    ]
+    if stops : fields.append(('stops', '<i2', (nchans,)))
+    return np.dtype(fields)
+
+
+class lappdRunWriter :
+    # regs : register snapshot {name : value}, e.g. lappdInterface.RegSnapshot()
+    # peds : pedestals, one row of nsamples per channel (or a single row)
+    # stops : records keep the stop cells (see lappdInterface.StopCells)
+    def __init__(self, fname, chans, nsamples = 1024, regs = {}, peds = None, qsize = 1024, stops = False) :
+        self.chans    = list(chans)
+        self.nsamples = nsamples
+        self.stops    = stops
+        self.dtype    = EventDtype(len(self.chans), nsamples, stops)
+        self.f        = open(fname, 'wb')
+        if peds is None : peds = np.zeros((0, nsamples))
+        peds = np.asarray(peds, dtype = '<f4').reshape(-1, nsamples)
+
+        meta = json.dumps({
+            'chans'    : self.chans,
+            'nsamples' : nsamples,
+            'ped_rows' : peds.shape[0],
+            'stops'    : stops,
+            'regs'     : regs,
+            'created'  : time.time()
+        }).encode()
+        self.f.write(RUN_HDR.pack(RUN_MAGIC, RUN_VERSION, len(meta)))
+        self.f.write(meta)
+        self.f.write(peds.tobytes())
+        self.f.write(b'\0' * (-self.f.tell() % RUN_ALIGN))
+
+        self.offsets  = []
+        self.pos      = self.f.tell()
+        self.nDropped = 0
+        self.error    = None
+        self.queue    = queue.Queue(qsize)
+        self.thread   = threading.Thread(target = self._Flusher, daemon = True)
+        self.thread.start()
+
+    # queue one event for writing, data : (nchans, nsamples), stops : (nchans)
+    # block = False : drop the event instead of waiting when the flusher is behind
+    def Write(self, evt, data, run = 0, t = None, block = True, stops = None) :
+        if self.error is not None : raise self.error
+        rec = np.zeros(1, dtype = self.dtype)
+        rec['run']  = run
+        rec['evt']  = evt
+        rec['time'] = time.time() if t is None else t
+        rec['data'] = data
+        if self.stops and stops is not None : rec['stops'] = stops
+        try :
+            self.queue.put(rec, block)
+        except queue.Full :
+            self.nDropped += 1
+
+    # write lappdRx.lappdEvent
+    def WriteEvent(self, ev, block = True) :
+        self.Write(ev.evt, ev.data, ev.run, block = block)
+
+    # after a write error the queue is still drained, so Write() and Close()
+    # never block, Write() raises the error
+    def _Flusher(self) :
+        while True :
+            rec = self.queue.get()
+            if rec is None : break
+            if self.error is not None : continue
+            try :
+                self.f.write(rec.tobytes())
+            except Exception as e :
+                self.error = e
+                continue
+            self.offsets.append(self.pos)
+            self.pos += self.dtype.itemsize
+
+    def Close(self) :
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None :
+            self.f.close()
+            raise self.error
+        idx = np.asarray(self.offsets, dtype = '<u8')
+        self.f.write(idx.tobytes())
+        self.f.write(RUN_FOOTER.pack(len(idx), self.pos, RUN_IDX_MAGIC))
+        self.f.close()
+        if self.nDropped : print('run file : %d events dropped' % (self.nDropped), file=sys.stderr)
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *args) :
+        self.Close()
+
+
+class lappdRunReader :
+    def __init__(self, fname) :
+        with open(fname, 'rb') as f :
+            magic, ver, nmeta = RUN_HDR.unpack(f.read(RUN_HDR.size))
+            if magic != RUN_MAGIC :
+                raise Exception('%s is not a LAPPD run file' % (fname))
+            if ver != RUN_VERSION :
+                raise Exception('unsupported run file version : %d' % (ver))
+            self.meta     = json.loads(f.read(nmeta))
+            self.chans    = self.meta['chans']
+            self.nsamples = self.meta['nsamples']
+            self.regs     = self.meta['regs']
+            self.stops    = self.meta.get('stops', False)
+            nped = self.meta['ped_rows']
+            self.peds = np.frombuffer(f.read(4 * nped * self.nsamples), dtype = '<f4').reshape(nped, self.nsamples)
+            start = f.tell()
+            start += -start % RUN_ALIGN
+            f.seek(0, 2)
+            size = f.tell()
+            footer = None
+            if size >= start + RUN_FOOTER.size :
+                f.seek(size - RUN_FOOTER.size)
+                footer = RUN_FOOTER.unpack(f.read(RUN_FOOTER.size))
+
+        self.dtype = EventDtype(len(self.chans), self.nsamples, self.stops)
+        if footer is not None and footer[2] == RUN_IDX_MAGIC :
+            nev, idxpos = footer[0], footer[1]
+            self.index = np.memmap(fname, dtype = '<u8', mode = 'r', offset = idxpos, shape = (nev,))
+        else :
+            # run was not closed : recover complete records, no index
+            nev = (size - start) // self.dtype.itemsize
+            self.index = start + np.arange(nev, dtype = np.uint64) * self.dtype.itemsize
+        self.nevents = nev
+        self.events  = np.memmap(fname, dtype = self.dtype, mode = 'r', offset = start, shape = (nev,)) \
+                       if nev > 0 else np.zeros(0, dtype = self.dtype)
+        self.start   = start
+
+    def __len__(self) :
+        return self.nevents
+
+    # i-th event record (run, evt, time, data) without loading the run
+    def __getitem__(self, i) :
+        return self.events[(int(self.index[i]) - self.start) // self.dtype.itemsize]
+
+    # samples of the i-th event as (nchans, nsamples) np.int16
+    def Data(self, i) :
+        return self[i]['data']
+
+    # chunks of consecutive event records
+    def Chunks(self, nchunk = 1000) :
+        for i0 in range(0, self.nevents, nchunk) :
+            yield self.events[i0 : i0 + nchunk]
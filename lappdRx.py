@@ -0,0 +1,712 @@
+#!/usr/bin/python3
+
+import sys
+import socket
+import select
+import struct
+import time
+import heapq
+import threading
+import numpy as np
+
+from lappdIfc import DecodeAdcWords
+from lappdPeds import FLAG_LIMIT
+
+#####################################################
+# Event builder UDP packet (host side view)
+#
+#   u16 run number
+#   u32 event number
+#   u16 channel number
+#   u16 fragment number
+#   u16 number of fragments for this channel
+#   u16 first sample in the fragment
+#   u16 number of samples in the fragment
+#   followed by the raw 16-bit ADC words
+# all fields are big endian
+#####################################################
+PKT_HDR     = struct.Struct('>HIHHHHH')
+PKT_HDR_LEN = PKT_HDR.size
+PKT_MAXLEN  = 9000 # jumbo frame
+RCVBUF_SIZE = 1 << 25 # 32 MB socket receive buffer (limited by net.core.rmem_max)
+
+def ParseHeader(pkt) :
+    return PKT_HDR.unpack_from(pkt, 0)
+
+# split one event into event builder packets
+# data : raw ADC words, shape (nchans, nsamples)
+def MakePackets(run, evt, chans, data, nsamp_packet = 512) :
+    data = np.asarray(data, dtype = '>u2')
+    pkts = []
+    for ich, ch in enumerate(chans) :
+        nsamples = data.shape[1]
+        nfrag = (nsamples + nsamp_packet - 1) // nsamp_packet
+        for ifrag in range(nfrag) :
+            first = ifrag * nsamp_packet
+            words = data[ich, first : first + nsamp_packet]
+            hdr = PKT_HDR.pack(run & 0xffff, evt & 0xffffffff, ch, ifrag, nfrag, first, len(words))
+            pkts.append(hdr + words.tobytes())
+    return pkts
+
+# recorded packets : u32 length followed by the packet
+def SavePackets(fname, pkts) :
+    with open(fname, 'wb') as f :
+        for pkt in pkts :
+            f.write(struct.pack('>I', len(pkt)))
+            f.write(pkt)
+
+def LoadPackets(fname) :
+    pkts = []
+    with open(fname, 'rb') as f :
+        while True :
+            n = f.read(4)
+            if len(n) < 4 : break
+            pkts.append(f.read(struct.unpack('>I', n)[0]))
+    return pkts
+
+
+class lappdEvent :
+    def __init__(self, run, evt, chans, data) :
+        self.run   = run
+        self.evt   = evt
+        self.chans = chans # channel numbers, one per row of data
+        self.data  = data  # decoded samples np.int16 (nchans, nsamples)
+
+
+# zero suppressed event : (channel, cell, value) of the kept samples
+class lappdSparseEvent :
+    def __init__(self, run, evt, chans, cells, values) :
+        self.run    = run
+        self.evt    = evt
+        self.chans  = chans  # np.int16
+        self.cells  = cells  # np.int16
+        self.values = values # np.int16
+
+    def __len__(self) :
+        return len(self.values)
+
+    # back to (len(chanlist), nsamples), suppressed samples are 0,
+    # channels not in chanlist are left out
+    def ToDense(self, chanlist, nsamples = 1024) :
+        nch = max(max(chanlist), int(self.chans.max()) if len(self.chans) else 0) + 1
+        idx = np.full(nch, -1)
+        idx[list(chanlist)] = np.arange(len(chanlist))
+        data = np.zeros((len(chanlist), nsamples), dtype = np.int16)
+        rows = idx[self.chans]
+        ok = rows >= 0
+        data[rows[ok], self.cells[ok]] = self.values[ok]
+        return data
+
+# keep samples with |value| >= threshold of the channel ({chan : thr}),
+# without thresholds keep the non-zero samples (firmware zero suppression)
+# peds : pedestal rows of ev.chans (e.g. lappdInterface.PedRows(ev.chans)),
+#        subtracted before the comparison and from the kept values (ADC flags
+#        are kept as is). Without peds the event must come from the firmware
+#        with pedestal subtraction on (PedMemUpload), else the thresholds are
+#        compared with raw ADC values
+def SparseEvent(ev, thresholds = None, peds = None) :
+    data = ev.data
+    if peds is not None :
+        data = np.where(np.abs(data) >= FLAG_LIMIT, data, data - np.asarray(peds, dtype = np.int16)).astype(np.int16)
+    if thresholds is None :
+        keep = data != 0
+    else :
+        thr  = np.array([thresholds.get(ch, 0) for ch in ev.chans])[:, np.newaxis]
+        keep = np.abs(data) >= thr
+    ich, cells = np.nonzero(keep)
+    chans = np.asarray(ev.chans, dtype = np.int16)[ich]
+    return lappdSparseEvent(ev.run, ev.evt, chans, cells.astype(np.int16), data[ich, cells])
+
+
+#####################################################
+# Reassembly of fragmented packets into events
+#
+# events are accounted for in event number order : once
+# an event is more than window events older than the
+# newest one seen, it is dropped if still incomplete or
+# counted as lost if no packet of it ever arrived
+#
+# zerosup : firmware zero suppression may leave out whole
+# channels, which have no packet at all. An event with all
+# the fragments of the channels it has is then emitted
+# when it is settled (window events later or on Flush),
+# the missing channels are 0. An event without any packet
+# can not be told from a lost one and is counted as lost
+#####################################################
+class lappdEventBuilder :
+    def __init__(self, chans, nsamples = 1024, max_pending = 64, window = 32, zerosup = False) :
+        self.chans       = list(chans)
+        self.chidx       = {ch : i for i, ch in enumerate(self.chans)}
+        self.nsamples    = nsamples
+        self.max_pending = max_pending
+        self.window      = window # reorder window in events
+        self.zerosup     = zerosup
+        self.out         = [] # events completed while settling
+        self.pending     = {} # (run, evt) -> [raw words, fragments per chan, received fragments]
+        self.last        = {} # stream -> order key of the last packet
+        self.run         = None # current run
+        self.newest      = 0    # newest event number seen in the run
+        self.lowmark     = 0    # events up to lowmark are accounted for
+        self.retired     = set() # events above lowmark which were completed or dropped
+        self.ResetStats()
+
+    def ResetStats(self) :
+        self.nPackets    = 0
+        self.nBytes      = 0
+        self.nEvents     = 0
+        self.nBadPackets = 0
+        self.nDuplicates = 0
+        self.nOutOfOrder = 0
+        self.nOutOfOrderStream = {}
+        self.nLostEvents = 0
+        self.nDropped    = 0 # missing fragments of lost events
+        self.nLateRun    = 0 # late packets of a previous run, discarded
+
+    # returns list of completed events
+    # stream : source of the packet (e.g. UDP port), ordering is checked per stream
+    def AddPacket(self, pkt, stream = 0) :
+        self.nPackets += 1
+        self.nBytes   += len(pkt)
+        if len(pkt) < PKT_HDR_LEN :
+            self.nBadPackets += 1
+            return []
+        run, evt, ch, ifrag, nfrag, first, nsamp = ParseHeader(pkt)
+        ich = self.chidx.get(ch, -1)
+        if ich < 0 or ifrag >= nfrag or first + nsamp > self.nsamples or \
+           len(pkt) < PKT_HDR_LEN + 2*nsamp :
+            self.nBadPackets += 1
+            return []
+
+        key = (run, evt)
+        okey = (run, evt, ich, ifrag)
+        last = self.last.get(stream)
+        if last is not None and okey < last :
+            self.nOutOfOrder += 1
+            self.nOutOfOrderStream[stream] = self.nOutOfOrderStream.get(stream, 0) + 1
+        else :
+            self.last[stream] = okey
+        if run != self.run :
+            # runs only go forward (16-bit run number wraps around)
+            if self.run is not None and (run - self.run) & 0xffff >= 0x8000 :
+                self.nLateRun += 1
+                return []
+            self._NewRun(run, evt)
+        if (evt <= self.lowmark or evt in self.retired) and key not in self.pending :
+            # late packet of an event which is already gone
+            return []
+
+        ent = self.pending.get(key)
+        if ent is None :
+            ent = [np.zeros((len(self.chans), self.nsamples), dtype = np.uint16),
+                   np.full(len(self.chans), -1, dtype = np.int32),
+                   set()]
+            self.pending[key] = ent
+        if (ich, ifrag) in ent[2] :
+            self.nDuplicates += 1
+            return []
+        ent[2].add((ich, ifrag))
+        ent[1][ich] = nfrag
+        ent[0][ich, first : first + nsamp] = np.frombuffer(pkt, dtype = '>u2', count = nsamp, offset = PKT_HDR_LEN)
+
+        if np.all(ent[1] >= 0) and len(ent[2]) == int(ent[1].sum()) :
+            del self.pending[key]
+            self._Complete(key, ent)
+        if evt > self.newest :
+            self.newest = evt
+            self._Account(self.newest - self.window)
+        while len(self.pending) > self.max_pending :
+            self._Drop(min(self.pending))
+        done, self.out = self.out, []
+        return done
+
+    # settle all pending events, count missing events up to the newest one,
+    # returns the events completed by it (zerosup)
+    def Flush(self) :
+        if self.run is not None : self._Account(self.newest)
+        done, self.out = self.out, []
+        return done
+
+    def _Complete(self, key, ent) :
+        self.retired.add(key[1])
+        self.nEvents += 1
+        self.out.append(lappdEvent(key[0], key[1], self.chans, DecodeAdcWords(ent[0])))
+
+    def _NewRun(self, run, evt) :
+        if self.run is not None : self._Account(self.newest)
+        for key in sorted(self.pending) : self._Drop(key)
+        self.run     = run
+        self.newest  = evt
+        self.lowmark = evt - 1
+        self.retired = set()
+
+    # settle events up to upto : incomplete ones are dropped, never seen ones are lost
+    def _Account(self, upto) :
+        while self.lowmark < upto :
+            evt = self.lowmark + 1
+            if (self.run, evt) in self.pending :
+                self._Drop((self.run, evt))
+            elif evt not in self.retired :
+                self.nLostEvents += 1
+                self.nDropped    += len(self.chans) # one fragment per channel at least
+            self.retired.discard(evt)
+            self.lowmark = evt
+
+    def _Drop(self, key) :
+        ent = self.pending.pop(key)
+        if self.zerosup and len(ent[2]) == int(ent[1][ent[1] >= 0].sum()) and key[0] == self.run :
+            # channels without packets were suppressed
+            self._Complete(key, ent)
+            return
+        # channels without any packet count as one missing fragment
+        nexp = int(np.where(ent[1] >= 0, ent[1], 1).sum())
+        self.nDropped += nexp - len(ent[2])
+        self.nLostEvents += 1
+        if key[0] == self.run : self.retired.add(key[1])
+
+    def Stats(self) :
+        return {
+            'packets'     : self.nPackets,
+            'bytes'       : self.nBytes,
+            'events'      : self.nEvents,
+            'bad'         : self.nBadPackets,
+            'duplicates'  : self.nDuplicates,
+            'outoforder'  : self.nOutOfOrder,
+            'lost_events' : self.nLostEvents,
+            'dropped'     : self.nDropped,
+            'late_run'    : self.nLateRun,
+            'pending'     : len(self.pending)
+        }
+
+
+#####################################################
+# Preallocated packet ring buffer
+#
+# sockets receive directly into fixed size slots with
+# recv_into, consumers get memoryview slices of the slots
+# and release them when done. One writer, one reader.
+# policy when all slots are used :
+#   'block'       : writer waits for the reader (backpressure)
+#   'drop_oldest' : oldest unread packet is overwritten
+#####################################################
+class lappdPacketRing :
+    def __init__(self, nslots = 4096, slotsize = PKT_MAXLEN, policy = 'block', notify = None) :
+        if policy not in ['block', 'drop_oldest'] :
+            raise Exception('wrong ring buffer policy : %s' % (policy))
+        self.nslots   = nslots
+        self.slotsize = slotsize
+        self.policy   = policy
+        self.notify   = notify # threading.Event set when packets are committed
+        self.buf      = np.zeros((nslots, slotsize), dtype = np.uint8)
+        self.lens     = np.zeros(nslots, dtype = np.int32)
+        self.slots    = [memoryview(self.buf[i]) for i in range(nslots)]
+        self.cond     = threading.Condition()
+        # free <= read <= head : [free, read) held by reader, [read, head) unread
+        self.head     = 0
+        self.read     = 0
+        self.free     = 0
+        self.nDropped = 0 # packets overwritten in drop_oldest mode
+        self.nWaits   = 0 # times the writer had to wait for the reader
+
+    def __len__(self) :
+        return self.head - self.read
+
+    # returns slot index to write into, None on timeout
+    def _WriteSlot(self, timeout) :
+        with self.cond :
+            while self.head - self.free >= self.nslots :
+                if self.policy == 'drop_oldest' and self.free == self.read :
+                    self.read += 1
+                    self.free += 1
+                    self.nDropped += 1
+                    break
+                self.nWaits += 1
+                if not self.cond.wait(timeout) : return None
+            return self.head % self.nslots
+
+    # receive one packet from sock into the next slot, returns its length (0 if nothing received)
+    def RecvInto(self, sock, flags = 0, timeout = 0.1) :
+        islot = self._WriteSlot(timeout)
+        if islot is None : return 0
+        n = sock.recv_into(self.slots[islot], self.slotsize, flags)
+        self.lens[islot] = n
+        with self.cond :
+            self.head += 1
+        return n
+
+    # oldest unread packet as memoryview without taking it, None if empty
+    def Peek(self) :
+        with self.cond :
+            if self.read == self.head : return None
+            islot = self.read % self.nslots
+        return self.slots[islot][:self.lens[islot]]
+
+    # oldest unread packet as memoryview, None if empty
+    def Get(self) :
+        with self.cond :
+            if self.read == self.head : return None
+            islot = self.read % self.nslots
+            self.read += 1
+        return self.slots[islot][:self.lens[islot]]
+
+    # give back the n oldest packets obtained with Get
+    def Release(self, n = 1) :
+        with self.cond :
+            self.free = min(self.free + n, self.read)
+            self.cond.notify()
+
+    def Stats(self) :
+        return {
+            'used'    : self.head - self.free,
+            'dropped' : self.nDropped,
+            'waits'   : self.nWaits
+        }
+
+
+#####################################################
+# UDP receiver for the event builder stream
+#####################################################
+class lappdReceiver :
+    # zerosup : the stream is zero suppressed, see lappdEventBuilder
+    def __init__(self, chans, ports = [8990], host = '', nsamples = 1024, callback = None, zerosup = False) :
+        self.builder  = lappdEventBuilder(chans, nsamples, zerosup = zerosup)
+        self.callback = callback
+        self.running  = False
+        self.rxbuf    = memoryview(bytearray(PKT_MAXLEN))
+        self.socks    = []
+        for port in ports :
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+            s.bind((host, port))
+            s.setblocking(False)
+            self.socks.append(s)
+
+    # receive whatever is available within timeout, returns completed events
+    def Poll(self, timeout = 0.1) :
+        events = []
+        rdy, _, _ = select.select(self.socks, [], [], timeout)
+        for s in rdy :
+            while True :
+                try :
+                    n = s.recv_into(self.rxbuf)
+                except BlockingIOError :
+                    break
+                events.extend(self.builder.AddPacket(self.rxbuf[:n], s.fileno()))
+        if self.callback is not None :
+            for ev in events : self.callback(ev)
+        return events
+
+    def __iter__(self) :
+        self.running = True
+        while self.running :
+            for ev in self.Poll() :
+                yield ev
+
+    # settle pending events : incomplete ones are counted as lost
+    def Flush(self) :
+        events = self.builder.Flush()
+        if self.callback is not None :
+            for ev in events : self.callback(ev)
+        return events
+
+    # receive nev events (all if nev < 0) or until Stop() / timeout without data,
+    # the pending events are settled after an idle timeout
+    def Run(self, nev = -1, idle_timeout = -1) :
+        self.running = True
+        n = 0
+        tlast = time.time()
+        while self.running and (nev < 0 or n < nev) :
+            events = self.Poll()
+            if len(events) : tlast = time.time()
+            elif idle_timeout > 0 and time.time() - tlast > idle_timeout :
+                n += len(self.Flush())
+                break
+            n += len(events)
+        return n
+
+    def Stop(self) :
+        self.running = False
+
+    def Close(self) :
+        self.running = False
+        self.Flush()
+        for s in self.socks : s.close()
+        self.socks = []
+
+    def Stats(self) :
+        return self.builder.Stats()
+
+
+#####################################################
+# Multiple UDP ports mode (NUDPPORTS > 1) : one reader
+# thread per port, socket calls release the GIL so the
+# readers run in parallel, reassembly is done in the
+# merge stage
+#####################################################
+class lappdPortReader(threading.Thread) :
+    def __init__(self, iport, port, notify, host = '', rcvbuf = RCVBUF_SIZE, batch = 64,
+                 nslots = 4096, policy = 'block') :
+        threading.Thread.__init__(self, daemon = True)
+        self.iport   = iport
+        self.port    = port
+        self.notify  = notify # event shared with the merge stage
+        self.ring    = lappdPacketRing(nslots, PKT_MAXLEN, policy, notify)
+        self.batch   = batch
+        self.running = False
+        self.sock    = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.rcvbuf  = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+        self.timeout = 0.1 # s to wait for the first packet of a batch
+        self.nPackets    = 0
+        self.nBytes      = 0
+        self.nBatches    = 0
+        self.t0          = time.time()
+
+    # read up to batch packets per wake up into the ring : wait for the socket
+    # to be readable, then drain it without blocking (no recvmmsg in python)
+    def ReadBatch(self) :
+        rdy, _, _ = select.select([self.sock], [], [], self.timeout)
+        if len(rdy) == 0 : return 0
+        npkt = 0
+        nbytes = 0
+        while npkt < self.batch :
+            try :
+                n = self.ring.RecvInto(self.sock)
+            except BlockingIOError :
+                break
+            if n == 0 : break
+            npkt += 1
+            nbytes += n
+        self.nBytes += nbytes
+        return npkt
+
+    def run(self) :
+        self.running = True
+        self.t0 = time.time()
+        while self.running :
+            npkt = self.ReadBatch()
+            if npkt == 0 : continue
+            self.nPackets += npkt
+            self.nBatches += 1
+            self.notify.set()
+        self.sock.close()
+
+    def Stop(self) :
+        self.running = False
+
+    def Stats(self) :
+        dt = max(time.time() - self.t0, 1e-9)
+        return {
+            'port'       : self.port,
+            'rcvbuf'     : self.rcvbuf,
+            'packets'    : self.nPackets,
+            'bytes'      : self.nBytes,
+            'pkt_rate'   : self.nPackets / dt,
+            'mb_rate'    : self.nBytes / dt / 1e6,
+            'avg_batch'  : self.nPackets / max(self.nBatches, 1),
+            'ring_drops' : self.ring.nDropped,
+            'ring_waits' : self.ring.nWaits
+        }
+
+
+class lappdMultiPortReceiver :
+    def __init__(self, chans, ports, host = '', nsamples = 1024, callback = None,
+                 rcvbuf = RCVBUF_SIZE, window = 16, nslots = 4096, policy = 'block', lag = 16, hold = 0.1,
+                 zerosup = False) :
+        self.builder  = lappdEventBuilder(chans, nsamples, window = 2 * lag, zerosup = zerosup)
+        self.callback = callback
+        self.window   = window # max number of completed events held back for ordering
+        self.lag      = lag    # events a port may be behind before the merge waits for it
+        self.hold     = hold   # s to wait for a lagging port
+        self.tHold    = None
+        self.last     = [None] * len(ports) # (run, event) of the last packet merged per port
+        self.ready    = []     # heap of completed events waiting for older ones
+        self.notify   = threading.Event()
+        self.readers  = [lappdPortReader(i, p, self.notify, host, rcvbuf, nslots = nslots, policy = policy)
+                         for i, p in enumerate(ports)]
+        self.running  = False
+
+    def Start(self) :
+        for r in self.readers : r.start()
+
+    # (run, event) of the oldest packet in the ring of reader r, None if empty
+    def _Head(self, r) :
+        pkt = r.ring.Peek()
+        if pkt is None : return None
+        if len(pkt) < PKT_HDR_LEN : return () # bad packet, before everything
+        return ParseHeader(pkt)[:2]
+
+    # True to stop merging before key : a port without packets is more than
+    # lag events behind (its reader did not get to them yet), waits up to hold
+    def _Hold(self, key, heads) :
+        lagging = False
+        for r in self.readers :
+            if r.iport in heads : continue
+            if len(r.ring) > 0 : return True # new packets, merged on the next pass
+            last = self.last[r.iport]
+            if last is not None and len(key) and last < (key[0], key[1] - self.lag) : lagging = True
+        if not lagging :
+            self.tHold = None
+            return False
+        if self.tHold is None : self.tHold = time.time()
+        return time.time() - self.tHold < self.hold
+
+    # merge packets from all ports, returns completed events in (run, event) order
+    # the rings are merged by event number (every port is in order by itself), so
+    # the fragments of an event spread over the ports arrive close together
+    def Poll(self, timeout = 0.1) :
+        if self.notify.wait(timeout) : self.notify.clear()
+        heads = {}
+        for r in self.readers :
+            key = self._Head(r)
+            if key is not None : heads[r.iport] = key
+        order = [(key, iport) for iport, key in heads.items()]
+        heapq.heapify(order)
+        while len(order) :
+            key, iport = order[0]
+            if self._Hold(key, heads) : break
+            r = self.readers[iport]
+            # decode straight from the ring slots
+            for ev in self.builder.AddPacket(r.ring.Get(), iport) :
+                heapq.heappush(self.ready, ((ev.run, ev.evt), id(ev), ev))
+            r.ring.Release()
+            if len(key) : self.last[iport] = key
+            key = self._Head(r)
+            if key is None :
+                heapq.heappop(order)
+                del heads[iport]
+            else :
+                heapq.heapreplace(order, (key, iport))
+                heads[iport] = key
+        events = []
+        while len(self.ready) :
+            key = self.ready[0][0]
+            older = any(k < key for k in self.builder.pending)
+            if older and len(self.ready) <= self.window : break
+            events.append(heapq.heappop(self.ready)[2])
+        if self.callback is not None :
+            for ev in events : self.callback(ev)
+        return events
+
+    # release everything which is still held back
+    def Flush(self) :
+        for ev in self.builder.Flush() :
+            heapq.heappush(self.ready, ((ev.run, ev.evt), id(ev), ev))
+        events = [heapq.heappop(self.ready)[2] for i in range(len(self.ready))]
+        if self.callback is not None :
+            for ev in events : self.callback(ev)
+        return events
+
+    def __iter__(self) :
+        self.running = True
+        while self.running :
+            for ev in self.Poll() :
+                yield ev
+
+    def Run(self, nev = -1, idle_timeout = -1) :
+        self.running = True
+        n = 0
+        tlast = time.time()
+        while self.running and (nev < 0 or n < nev) :
+            events = self.Poll()
+            if len(events) : tlast = time.time()
+            elif idle_timeout > 0 and time.time() - tlast > idle_timeout : break
+            n += len(events)
+        return n
+
+    def Stop(self) :
+        self.running = False
+
+    def Close(self) :
+        self.running = False
+        for r in self.readers : r.Stop()
+        for r in self.readers : r.join()
+
+    def PortStats(self) :
+        stats = [r.Stats() for r in self.readers]
+        for st in stats : st['outoforder'] = 0
+        for iport, n in self.builder.nOutOfOrderStream.items() :
+            stats[iport]['outoforder'] = n
+        return stats
+
+    def Stats(self) :
+        st = self.builder.Stats()
+        st['ports'] = self.PortStats()
+        return st
+
+    def PrintStats(self, f = sys.stderr) :
+        print('%6s %10s %10s %8s %8s %6s %6s %6s' % ('port', 'packets', 'pkt/s', 'MB/s', 'batch', 'drop', 'wait', 'ooo'), file=f)
+        for st in self.PortStats() :
+            print('%6d %10d %10.0f %8.2f %8.1f %6d %6d %6d' % (st['port'], st['packets'], st['pkt_rate'],
+                  st['mb_rate'], st['avg_batch'], st['ring_drops'], st['ring_waits'], st['outoforder']), file=f)
+
+
+#####################################################
+# Replay of recorded packets to a local receiver
+#####################################################
+class lappdFakeSender :
+    def __init__(self, pkts, ports = [8990], host = '127.0.0.1') :
+        self.pkts  = pkts
+        self.ports = ports
+        self.host  = host
+        self.sock  = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    # packets are sprayed round robin over the ports like in multiple ports mode
+    # order : optional list of packet indices (to emulate reordering / losses)
+    def Send(self, order = None, delay = 0) :
+        if order is None : order = range(len(self.pkts))
+        for i, ipkt in enumerate(order) :
+            self.sock.sendto(self.pkts[ipkt], (self.host, self.ports[i % len(self.ports)]))
+            if delay > 0 : time.sleep(delay)
+
+    def Close(self) :
+        self.sock.close()
+
+
+# multiple ports receive with the sender running at the same time :
+# nev events of chans sprayed over nports ports starting at port,
+# returns the receiver statistics and the number of events received.
+# Without delay the sender can outrun the readers, the kernel then
+# drops packets (not counted when whole events are gone)
+def MultiPortLoadTest(nev = 2000, chans = range(8), nports = 3, port = 8990, nsamples = 1024,
+                      delay = 0, f = sys.stderr) :
+    chans = list(chans)
+    ports = [port + i for i in range(nports)]
+    data = (np.arange(nsamples) % 2048).astype(np.uint16) << 4
+    pkts = []
+    for evt in range(nev) :
+        pkts.extend(MakePackets(1, evt, chans, np.tile(data, (len(chans), 1))))
+    rx = lappdMultiPortReceiver(chans, ports, '127.0.0.1', nsamples)
+    rx.Start()
+    tx = lappdFakeSender(pkts, ports)
+    sender = threading.Thread(target = tx.Send, kwargs = {'delay' : delay}, daemon = True)
+    t0 = time.time()
+    sender.start()
+    nrx = rx.Run(nev, idle_timeout = 1.0)
+    sender.join()
+    nrx += len(rx.Flush())
+    wall = time.time() - t0
+    rx.Close()
+    tx.Close()
+    st = rx.Stats()
+    st['received'] = nrx
+    if f is not None :
+        print('%d of %d events in %.2f s (%.0f Hz), %d lost, %d fragments missing' % (nrx, nev, wall,
+              nrx / max(wall, 1e-9), st['lost_events'], st['dropped']), file=f)
+        rx.PrintStats(f)
+    return st
+
+if __name__ == '__main__' :
+    import argparse
+    ap = argparse.ArgumentParser(description = 'multiple UDP ports receive load test')
+    ap.add_argument('-n', '--nev', type = int, default = 2000)
+    ap.add_argument('-c', '--nchans', type = int, default = 8)
+    ap.add_argument('-p', '--nports', type = int, default = 3)
+    ap.add_argument('--port', type = int, default = 8990)
+    ap.add_argument('--delay', type = float, default = 0, help = 's between packets')
+    args = ap.parse_args()
+    st = MultiPortLoadTest(args.nev, range(args.nchans), args.nports, args.port, delay = args.delay, f = sys.stdout)
+    sys.exit(1 if st['received'] < args.nev else 0)
@@ -0,0 +1,357 @@
+#!/usr/bin/python3
+
+import time
+import socket
+import struct
+import threading
+import numpy as np
+
+from lappdIfc import *
+
+#####################################################
+# Simulated LAPPD board
+#
+# implements the eevee.board interface (peeknow, pokenow,
+# peek, poke, transfer) on top of a model of the register
+# map in lappdIfc :
+#   - ADC SPI test modes and custom test pattern
+#   - data IDELAY eye window and bitslip of every channel,
+#     frame IDELAY eye window of every ADC (STATUS bits)
+#   - DRS4 PLL lock, software and external triggers
+#   - ADC buffer FIFO at ADDR_ADCBUF_OFFSET filled with
+#     pedestal + noise (+ pulses, + TCA oscillator)
+#   - stop samples, pedestal memory and subtraction
+# network latency and packet loss are configurable
+#
+#   ifc = lappdInterface(brd = lappdSimBoard(latency = 1e-4))
+#####################################################
+class lappdSimBoard :
+    def __init__(self, fwver = 0x4, dna = 0x0123456789abcdef, seed = 1,
+                 latency = 0, jitter = 0, loss = 0, loss_timeout = 0.01,
+                 noise = 2.0, pulse_rate = 0, pll_lock_time = 0.002, frame_settle = 0.001,
+                 bitslip_frac = 0.1, tca_period = 51.2, tca_amp = 300) :
+        self.rng          = np.random.default_rng(seed)
+        self.latency      = latency      # s per transfer (round trip)
+        self.jitter       = jitter       # s, gaussian sigma of the latency
+        self.loss         = loss         # probability to lose a transfer
+        self.loss_timeout = loss_timeout # s, time lost by a retransmission
+        self.noise        = noise        # ADC counts
+        self.pulse_rate   = pulse_rate   # probability of a pulse per channel and event
+        self.pll_lock_time = pll_lock_time
+        self.frame_settle = frame_settle
+        self.tca_period   = tca_period   # TCA oscillator period in nominal cells
+        self.tca_amp      = tca_amp
+        self.sample_offset = 12          # lappdInterface.AdcSampleOffset
+
+        self.regs = {FW_VERSION : fwver, DEVICEDNA_L : dna & 0xffffffff, DEVICEDNA_H : dna >> 32,
+                     ADCBUFNUMWORDS : 1024}
+        self.queue = []
+        self.nTransfers    = 0
+        self.nTransactions = 0
+        self.nLost         = 0
+        self.nEvents       = 0
+
+        # ADC links : eye windows of data lines and frame, required bitslips
+        self.data_center  = self.rng.integers(8, 24, (2, 16))
+        self.data_width   = self.rng.integers(6, 12, (2, 16))
+        self.frame_center = self.rng.integers(8, 24, 2)
+        self.frame_width  = self.rng.integers(6, 12, 2)
+        self.need_slip    = (self.rng.random((2, 16)) < bitslip_frac).astype(int)
+        self.slip         = np.zeros((2, 16), dtype = int)
+        self.adcregs      = [{}, {}]
+        self.tframe       = [0, 0]  # time of the last frame delay change
+        self.frameprev    = [False, False] # frame lock before that change, shown while settling
+        self.tdenable     = None
+
+        # DRS4 : pedestals per sample (as measured by lappdInterface.MeasurePeds
+        # and subtracted by the firmware), widths per cell (in nominal cells)
+        self.peds   = self.rng.normal(0, 30, (64, 1024))
+        self.widths = 1 + self.rng.normal(0, 0.1, (64, 1024))
+        self.pedmem = np.zeros((64, 1024), dtype = np.int64)
+        self.stop   = np.zeros(8, dtype = int)
+        self.buf    = np.zeros((64, 4200), dtype = np.uint32)
+        self.bufpos = 0
+        self.curaddr = 0
+        self.lock   = threading.Lock()
+
+    #####################################################
+    # eevee.board interface
+    #####################################################
+    def peek(self, addr) :
+        self.queue.append((addr,))
+
+    def poke(self, addr, val) :
+        self.queue.append((addr, val))
+
+    def transfer(self) :
+        ops = self.queue
+        self.queue = []
+        self.Network()
+        return self.Exec(ops)
+
+    def peeknow(self, addr) :
+        self.Network()
+        return self.Exec([(addr,)])[0]
+
+    def pokenow(self, addr, val) :
+        self.Network()
+        self.Exec([(addr, val)])
+
+    # latency and loss of one round trip
+    def Network(self) :
+        self.nTransfers += 1
+        while self.loss > 0 and self.rng.random() < self.loss :
+            self.nLost += 1
+            time.sleep(self.loss_timeout)
+        if self.latency > 0 or self.jitter > 0 :
+            time.sleep(max(self.latency + self.jitter * self.rng.normal(), 0))
+
+    # execute transactions, one response per transaction
+    def Exec(self, ops) :
+        resp = []
+        with self.lock :
+            for op in ops :
+                self.nTransactions += 1
+                if len(op) == 1 :
+                    resp.append(self.Read(op[0]))
+                else :
+                    self.Write(op[0], op[1])
+                    resp.append(op[1])
+        return resp
+
+    #####################################################
+    # register model
+    #####################################################
+    def Read(self, addr) :
+        blk = addr & ~0x3ffff
+        if blk == ADDR_ADCBUF_OFFSET :
+            if addr == ADDR_ADCBUF_OFFSET + 4 :
+                self.bufpos = 0
+                return 0
+            ch = self.regs.get(ADCDEBUGCHAN, 0) % 64
+            if self.bufpos >= self.buf.shape[1] : return 0
+            self.bufpos += 1
+            return int(self.buf[ch, self.bufpos - 1])
+        if blk == ADDR_ADCSPI_OFFSET :
+            nadc = (addr >> 10) & 1
+            return self.adcregs[nadc].get((addr >> 2) & 0xff, 0)
+        if blk == ADDR_PEDMEM_OFFSET :
+            i = (addr - ADDR_PEDMEM_OFFSET) >> 2
+            return int(self.pedmem[i // 1024, i % 1024]) & PEDMEM_MASK
+        if blk != 0 :
+            return self.regs.get(addr, 0)
+
+        if addr == CMD : return 0
+        if addr == STATUS :
+            sta = 0
+            for nadc in range(2) :
+                settled = time.perf_counter() - self.tframe[nadc] >= self.frame_settle
+                if self.FrameOk(nadc) if settled else self.frameprev[nadc] :
+                    sta |= 1 << nadc
+            return sta
+        if addr == DRSPLLLCK :
+            ok = self.tdenable is not None and time.perf_counter() - self.tdenable >= self.pll_lock_time
+            return 0xff if ok else 0
+        if addr == ADCBUFCURADDR : return self.curaddr
+        if addr == ADCDEBUG1 : return self.DebugSample()
+        return self.regs.get(addr, 0)
+
+    def Write(self, addr, val) :
+        blk = addr & ~0x3ffff
+        if blk == ADDR_ADCSPI_OFFSET :
+            nadc = (addr >> 10) & 1
+            reg  = (addr >> 2) & 0xff
+            self.adcregs[nadc][reg] = val
+            return
+        if blk == ADDR_PEDMEM_OFFSET :
+            i = (addr - ADDR_PEDMEM_OFFSET) >> 2
+            v = val & PEDMEM_MASK
+            self.pedmem[i // 1024, i % 1024] = v - ((v & 0x800) << 1)
+            return
+        if blk != 0 :
+            self.regs[addr] = val
+            return
+
+        if addr == CMD :
+            if val & (1 << C_CMD_RESET_BIT) : self.slip[:] = 0
+            if val & (1 << C_CMD_ADCRESET_BIT) : self.adcregs = [{}, {}]
+            if val & (1 << C_CMD_READREQ_BIT) : self.Trigger()
+            return
+        if addr == MODE :
+            old = self.regs.get(MODE, 0)
+            if val & ~old & (1 << C_MODE_ADCBUF_WREN_BIT) : self.curaddr = 0
+            if val & ~old & (1 << C_MODE_DRS_DENABLE_BIT) : self.tdenable = time.perf_counter()
+            if not val & (1 << C_MODE_DRS_DENABLE_BIT) : self.tdenable = None
+        if addr in [ADCFRAMEDELAY_0, ADCFRAMEDELAY_0 + 4] :
+            nadc = (addr - ADCFRAMEDELAY_0) >> 2
+            self.frameprev[nadc] = self.FrameOk(nadc)
+            self.tframe[nadc] = time.perf_counter()
+        if addr in [BITSLIP, BITSLIP + 4] :
+            nadc = (addr - BITSLIP) >> 2
+            self.slip[nadc] += (val >> np.arange(16)) & 1
+        self.regs[addr] = val
+
+    def FrameOk(self, nadc) :
+        dly = self.regs.get(ADCFRAMEDELAY_0 + 4*nadc, 0)
+        return abs(dly - self.frame_center[nadc]) <= self.frame_width[nadc] // 2
+
+    # ADCDEBUG1 : test pattern if the data line of the debug channel is aligned
+    def DebugSample(self) :
+        ch   = self.regs.get(ADCDEBUGCHAN, 0)
+        nadc = (ch // 32) & 1
+        chn  = (ch % 32) // 2
+        mode = (self.adcregs[nadc].get(2, 0) >> 7) & 7
+        if mode != 3 : return int(self.rng.integers(0, 0x1000))
+        pattern = (self.adcregs[nadc].get(5, 0) >> 4) & 0xfff
+        dly = self.regs.get(ADCDATADELAY_0 + 16*nadc*4 + 4*chn, 0)
+        ok  = abs(dly - self.data_center[nadc, chn]) <= self.data_width[nadc, chn] // 2
+        if not self.FrameOk(nadc) and self.regs.get(ADCFRAMEDELAY_0 + 4*nadc) is not None : ok = False
+        if self.slip[nadc, chn] % 12 != self.need_slip[nadc, chn] : ok = False
+        if ok : return pattern
+        # wrong sampling point : a bit slipped pattern
+        return ((pattern << 1) | (pattern >> 11)) & 0xfff
+
+    #####################################################
+    # events
+    #####################################################
+
+    # external trigger input
+    def ExtTrigger(self) :
+        with self.lock :
+            self.regs[EXTTRGCNT] = (self.regs.get(EXTTRGCNT, 0) + 1) & 0xffffffff
+            if self.regs.get(MODE, 0) & (1 << C_MODE_EXTTRG_EN_BIT) : self.Trigger()
+
+    def Trigger(self) :
+        mode = self.regs.get(MODE, 0)
+        nsamples = self.regs.get(ADCBUFNUMWORDS, 1024)
+        if nsamples <= 0 : nsamples = 1024
+        nwords = max(4200, self.sample_offset + 4*nsamples)
+
+        self.stop = self.rng.integers(0, 1024, 8)
+        for i in range(8) : self.regs[DRSSTOPSAMPLE_0 + 4*i] = int(self.stop[i])
+        cells = (self.stop[np.arange(64) // 8, np.newaxis] + np.arange(nsamples)) % 1024
+        rows  = np.arange(64)[:, np.newaxis]
+        pos = np.arange(nsamples) % 1024
+        v = self.peds[:, pos] + self.rng.normal(0, self.noise, (64, nsamples))
+        if mode & (1 << C_MODE_TCA_ENA_BIT) :
+            # sample i is taken at the start of its cell
+            w = self.widths[rows, cells]
+            t = np.cumsum(w, axis = 1) - w
+            phase = self.rng.random((64, 1)) * 2*np.pi
+            v += self.tca_amp * np.sin(2*np.pi * t / self.tca_period + phase)
+        if self.pulse_rate > 0 :
+            hit = self.rng.random(64) < self.pulse_rate
+            t0  = self.rng.uniform(100, nsamples - 100, 64)[:, np.newaxis]
+            amp = self.rng.uniform(50, 1500, 64)[:, np.newaxis]
+            v  -= hit[:, np.newaxis] * amp * np.exp(-0.5 * ((np.arange(nsamples) - t0) / 3.0)**2)
+        if mode & (1 << C_MODE_PEDSUB_EN_BIT) :
+            v -= self.pedmem[:, pos]
+
+        v = np.clip(np.rint(v), -2048, 2047).astype(np.int64)
+        words = (v & 0xfff).astype(np.uint32) << 4
+        self.buf = np.zeros((64, nwords), dtype = np.uint32)
+        self.buf[:, self.sample_offset : self.sample_offset + 4*nsamples] = np.repeat(words, 4, axis = 1)
+        self.bufpos  = 0
+        self.curaddr = nwords
+        self.nEvents += 1
+
+
+#####################################################
+# UDP loopback : the simulated board served over UDP
+#
+#   request  : u16 seq, u16 n, n x (u8 write, u32 addr, u32 value)
+#   response : u16 seq, u16 n, n x u32 value
+#####################################################
+SIM_REQ_HDR = struct.Struct('>HH')
+SIM_REQ_OP  = struct.Struct('>BII')
+SIM_MAXOPS  = 1000
+
+class lappdSimServer(threading.Thread) :
+    # latency and loss of the board are applied per request
+    def __init__(self, board, host = '127.0.0.1', port = 0) :
+        threading.Thread.__init__(self, daemon = True)
+        self.board = board
+        self.sock  = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.settimeout(0.1)
+        self.addr  = self.sock.getsockname()
+        self.running = False
+
+    def run(self) :
+        self.running = True
+        brd = self.board
+        while self.running :
+            try :
+                pkt, src = self.sock.recvfrom(65536)
+            except socket.timeout :
+                continue
+            brd.nTransfers += 1
+            if brd.loss > 0 and brd.rng.random() < brd.loss :
+                brd.nLost += 1
+                continue
+            if brd.latency > 0 or brd.jitter > 0 :
+                time.sleep(max(brd.latency + brd.jitter * brd.rng.normal(), 0))
+            seq, n = SIM_REQ_HDR.unpack_from(pkt, 0)
+            ops = []
+            for i in range(n) :
+                wr, addr, val = SIM_REQ_OP.unpack_from(pkt, SIM_REQ_HDR.size + i*SIM_REQ_OP.size)
+                ops.append((addr, val) if wr else (addr,))
+            resp = brd.Exec(ops)
+            self.sock.sendto(SIM_REQ_HDR.pack(seq, n) + struct.pack('>%dI' % n, *resp), src)
+        self.sock.close()
+
+    def Stop(self) :
+        self.running = False
+
+
+# board backend talking to lappdSimServer
+class lappdSimClient :
+    def __init__(self, addr, timeout = 0.05, retries = 10) :
+        self.addr    = addr
+        self.timeout = timeout
+        self.retries = retries
+        self.sock    = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(timeout)
+        self.queue   = []
+        self.seq     = 0
+        self.nRetrans = 0
+
+    def peek(self, addr) :
+        self.queue.append((addr,))
+
+    def poke(self, addr, val) :
+        self.queue.append((addr, val))
+
+    def peeknow(self, addr) :
+        self.peek(addr)
+        return self.transfer()[0]
+
+    def pokenow(self, addr, val) :
+        self.poke(addr, val)
+        self.transfer()
+
+    def transfer(self) :
+        ops = self.queue
+        self.queue = []
+        resp = []
+        for i0 in range(0, len(ops), SIM_MAXOPS) :
+            resp += self.Send(ops[i0 : i0 + SIM_MAXOPS])
+        return resp
+
+    def Send(self, ops) :
+        self.seq = (self.seq + 1) & 0xffff
+        pkt = SIM_REQ_HDR.pack(self.seq, len(ops)) + b''.join(
+              SIM_REQ_OP.pack(1, op[0], op[1]) if len(op) == 2 else SIM_REQ_OP.pack(0, op[0], 0) for op in ops)
+        for itry in range(self.retries + 1) :
+            self.sock.sendto(pkt, self.addr)
+            try :
+                while True :
+                    rsp = self.sock.recv(65536)
+                    seq, n = SIM_REQ_HDR.unpack_from(rsp, 0)
+                    if seq == self.seq : return list(struct.unpack_from('>%dI' % n, rsp, SIM_REQ_HDR.size))
+            except socket.timeout :
+                self.nRetrans += 1
+        raise TimeoutError('no response from simulated board %s:%d' % self.addr)
+
+    def Close(self) :
+        self.sock.close()
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+import os
+import numpy as np
+
+#####################################################
+# DRS4 cell timing calibration
+#
+# events of the time calibration oscillator (TCA, a sine
+# of known period) are aligned by their stop sample, the
+# rising zero crossings give intervals of exactly one
+# period, each interval is a linear equation in the widths
+# of the cells it covers (fractional at both ends). The
+# voltage step over the cell of every crossing adds a local
+# equation for the width of that cell (slope of the sine),
+# which fixes the structures one period long the interval
+# equations are blind to.
+# Add() only keeps the crossings, Solve() builds the normal
+# equations of all channels and solves them in batches
+#
+#   tcal = lappdTimeCalib(chans, period = 10.0)
+#   tcal.Add(data, stops) # (nev, nchans, nsamples), (nev, nchans)
+#   tcal.Solve()
+#   t, v = tcal.Apply(wfs, stops)
+#####################################################
+class lappdTimeCalib :
+    # period : TCA oscillator period, the widths are in the same unit
+    def __init__(self, chans, period = 10.0, ncells = 1024) :
+        self.chans  = list(chans)
+        self.period = period
+        self.ncells = ncells
+        self.Reset()
+
+    def Reset(self) :
+        self.ua  = [[] for ch in self.chans] # interval start, unrolled cell coordinate
+        self.ub  = [[] for ch in self.chans] # interval end
+        self.lc  = [[] for ch in self.chans] # cell of a crossing
+        self.lw  = [[] for ch in self.chans] # width of that cell from the slope
+        self.nev = 0
+        self.widths = np.zeros((len(self.chans), self.ncells))
+        self.resid  = np.zeros(len(self.chans)) # rms of the period residuals
+        self.solved = False
+
+    # data  : pedestal subtracted TCA events (nchans, nsamples) or (nev, nchans, nsamples)
+    # stops : stop cell of every event and channel, (nchans) or (nev, nchans)
+    # minamp : ignore channels with a smaller peak to peak amplitude
+    def Add(self, data, stops, minamp = 50) :
+        x = np.asarray(data, dtype = np.float64)
+        s = np.asarray(stops, dtype = np.int64)
+        if x.ndim == 2 : x, s = x[np.newaxis], s[np.newaxis]
+        nev, nch, ns = x.shape
+        x = x - x.mean(axis = 2, keepdims = True)
+        amp = (x.max(axis = 2) - x.min(axis = 2)) / 2
+        ok = 2 * amp > minamp
+
+        # rising zero crossings with linear interpolation, in samples
+        up = (x[:, :, :-1] < 0) & (x[:, :, 1:] >= 0) & ok[:, :, np.newaxis]
+        iev, ich, isam = np.nonzero(up)
+        a = x[iev, ich, isam]
+        b = x[iev, ich, isam + 1]
+        pos = isam + a / (a - b) + s[iev, ich]
+
+        # local widths at rising and falling crossings : step / (A * 2 pi / period)
+        cross = ((x[:, :, :-1] < 0) != (x[:, :, 1:] < 0)) & ok[:, :, np.newaxis]
+        lev, lch, lsam = np.nonzero(cross)
+        lw = np.abs(x[lev, lch, lsam + 1] - x[lev, lch, lsam]) * self.period / (2*np.pi * amp[lev, lch])
+        lc = (lsam + s[lev, lch]) % self.ncells
+
+        # consecutive crossings of the same event and channel
+        same = (iev[1:] == iev[:-1]) & (ich[1:] == ich[:-1])
+        ua, ub, ch = pos[:-1][same], pos[1:][same], ich[:-1][same]
+        # reject intervals far from the typical period (noise, glitches)
+        if len(ua) > 0 :
+            l = ub - ua
+            med = np.median(l)
+            sel = np.abs(l - med) < 0.3 * med
+            ua, ub, ch = ua[sel], ub[sel], ch[sel]
+        for i in range(nch) :
+            self.ua[i].append(ua[ch == i])
+            self.ub[i].append(ub[ch == i])
+            self.lc[i].append(lc[lch == i])
+            self.lw[i].append(lw[lch == i])
+        self.nev += nev
+
+    # intervals of channel index i
+    def Intervals(self, i) :
+        if len(self.ua[i]) == 0 : return np.zeros(0), np.zeros(0)
+        return np.concatenate(self.ua[i]), np.concatenate(self.ub[i])
+
+    # rows of the linear system : overlap of the intervals with every
+    # cell, unrolled over two turns and folded back, (nint, ncells)
+    def Rows(self, ua, ub) :
+        k = np.arange(2 * self.ncells)
+        c = np.minimum(ub[:, np.newaxis], k + 1) - np.maximum(ua[:, np.newaxis], k)
+        c = np.clip(c, 0, 1)
+        return c[:, :self.ncells] + c[:, self.ncells:]
+
+    # local width equations of channel index i : cells and widths
+    def Local(self, i) :
+        if len(self.lc[i]) == 0 : return np.zeros(0, dtype = np.int64), np.zeros(0)
+        return np.concatenate(self.lc[i]), np.concatenate(self.lw[i])
+
+    # least squares widths with a weak pull to the mean width,
+    # cells never covered by an interval get the mean width
+    # local : weight of the local equations, 0 for intervals only
+    # batch : channels solved at once, chunk : intervals per matrix product
+    def Solve(self, local = 1.0, ridge = 1e-3, batch = 8, chunk = 2048) :
+        n = self.ncells
+        for i0 in range(0, len(self.chans), batch) :
+            ich = range(i0, min(i0 + batch, len(self.chans)))
+            ata = np.zeros((len(ich), n, n))
+            atb = np.zeros((len(ich), n))
+            w0  = np.zeros(len(ich))
+            for j, i in enumerate(ich) :
+                ua, ub = self.Intervals(i)
+                if len(ua) == 0 : continue
+                w0[j] = self.period / np.mean(ub - ua)
+                for k0 in range(0, len(ua), chunk) :
+                    a = self.Rows(ua[k0 : k0 + chunk], ub[k0 : k0 + chunk])
+                    ata[j] += a.T @ a
+                    atb[j] += a.sum(axis = 0) * self.period
+                lc, lw = self.Local(i)
+                ata[j][np.diag_indices(n)] += local * np.bincount(lc, minlength = n)
+                atb[j] += local * np.bincount(lc, lw, minlength = n)
+            lam = ridge * np.maximum(np.diagonal(ata, axis1 = 1, axis2 = 2).mean(axis = 1), 1)
+            ata += lam[:, np.newaxis, np.newaxis] * np.eye(n)
+            atb += lam[:, np.newaxis] * w0[:, np.newaxis]
+            self.widths[i0 : i0 + len(ich)] = np.linalg.solve(ata, atb[:, :, np.newaxis])[:, :, 0]
+            for j, i in enumerate(ich) :
+                ua, ub = self.Intervals(i)
+                if len(ua) == 0 : continue
+                r = self.Rows(ua[:chunk], ub[:chunk]) @ self.widths[i] - self.period
+                self.resid[i] = np.sqrt(np.mean(r * r))
+        self.solved = True
+        return self.widths
+
+    # sample times (nchans, nsamples) or (nev, nchans, nsamples), the first
+    # sample is at 0, stops as in Add()
+    # rows : calibration row of each channel, all channels by default
+    def Times(self, stops, nsamples = 1024, rows = None) :
+        s = np.asarray(stops, dtype = np.int64)
+        if rows is None : rows = np.arange(len(self.chans))
+        cells = (s[..., np.newaxis] + np.arange(nsamples)) % self.ncells
+        w = self.widths[np.asarray(rows)[:, np.newaxis], cells]
+        t = np.cumsum(w, axis = -1)
+        return t - w
+
+    # times and waveforms in one step, cellorder : rotate both so index i is
+    # DRS4 cell i (nsamples = ncells only), times are then relative to the stop cell
+    def Apply(self, data, stops, cellorder = False, rows = None) :
+        v = np.asarray(data)
+        s = np.asarray(stops, dtype = np.int64)
+        t = self.Times(s, v.shape[-1], rows)
+        if cellorder :
+            idx = (np.arange(self.ncells) - s[..., np.newaxis]) % self.ncells
+            t = np.take_along_axis(t, idx, axis = -1)
+            v = np.take_along_axis(v, idx, axis = -1)
+        return t, v
+
+    # row index of channel ch
+    def Index(self, ch) :
+        return self.chans.index(ch)
+
+    # written to fname as given (np.savez would append .npz to a name without it)
+    def Save(self, fname) :
+        with open(fname, 'wb') as f :
+            np.savez(f, chans = self.chans, period = self.period, widths = self.widths,
+                     resid = self.resid, nev = self.nev)
+
+    @staticmethod
+    def Load(fname) :
+        # files written by np.savez under a name without .npz
+        if not os.path.exists(fname) and os.path.exists(fname + '.npz') : fname += '.npz'
+        f = np.load(fname)
+        t = lappdTimeCalib(f['chans'].tolist(), float(f['period']), f['widths'].shape[1])
+        t.widths = f['widths']
+        t.resid  = f['resid']
+        t.nev    = int(f['nev'])
+        t.solved = True
+        return t